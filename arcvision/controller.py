@@ -13,7 +13,8 @@ zmq.asyncio.install()
 
 class Controller:
     '''Controls flow of reactor program'''
-    def __init__(self, zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname):
+    def __init__(self, zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname, detector=None, warm_detector=False, identify_workers=0, detector_batch=1):
+        self.start_time = time.time()
         self.ctx = zmq.asyncio.Context()
 
         #subscribe to publishing socket
@@ -42,7 +43,21 @@ class Controller:
                          'descriptor': 'AKAZE',
                          'descriptor_threshold': 0.0002,
                          'descriptor_threshold_bounds': (0.00005,0.01),
-                         'descriptor_threshold_step': 0.0005}
+                         'descriptor_threshold_step': 0.0005,
+                         'keypoint_budget_auto': False,
+                         'identify_target_ms': 50,
+                         'identify_workers': identify_workers,
+                         'prefilter_k': 0,
+                         'template_size': 0,
+                         'template_keypoints': 0,
+                         'darkflow_roi': False,
+                         'detector_batch': detector_batch}
+        # backend and its options for the darkflow models
+        self.detector = {'backend': 'tensorflow'} if detector is None else detector
+        self.settings['detector_backend'] = self.detector['backend']
+        # models are loaded by the first frame that needs them, unless warmed once we are streaming
+        self.warm_detector = warm_detector
+        self.startup_time = None
         self.modes = ['background',
                       'detection',
                       'darkflow',
@@ -65,6 +80,8 @@ class Controller:
                 #somehow we can end up here before we finished reset processors
                 #hack TODO: find out why
                 pass
+        if self.settings['mode'] == 'detection' and len(self.processors) > 0:
+            self.settings['detection_stats'] = self.processors[0].budget.stats
         return json.dumps(self.__dict__, default=lambda x: '')
 
 
@@ -79,7 +96,7 @@ class Controller:
 
         self.background = None
         self.background_processor = BackgroundProcessor(self.cam)
-        self.transform_processor = SpatialCalibrationProcessor(self.cam, delay=8, stay=16, segmenter=DarkflowSegmentProcessor(self.cam))
+        self.transform_processor = SpatialCalibrationProcessor(self.cam, delay=8, stay=16, segmenter=DarkflowSegmentProcessor(self.cam, **self.detector))
         #self.transform_processor = SpatialCalibrationProcessor(self.cam, background=self.background)
         self.reserved_processors = [self.transform_processor]
 
@@ -97,10 +114,26 @@ class Controller:
         #self.projector_processor.transform = self.transform_processor.inv_transform
 
     def _start_detection(self):
+        budget = KeypointBudget(enabled=self.settings['keypoint_budget_auto'],
+                                target_ms=self.settings['identify_target_ms'])
         self.processors = [DetectionProcessor(self.cam, self.background,
-                                              self.img_db, self.descriptor)]
+                                              self.img_db, self.descriptor, budget=budget,
+                                              workers=self.settings['identify_workers'],
+                                              prefilter_k=self.settings['prefilter_k'],
+                                              template_size=self.settings['template_size'] or None,
+                                              template_keypoints=self.settings['template_keypoints'] or None)]
     def _start_darkflow(self):
-        self.processors = [DarkflowDetectionProcessor(self.cam, self.background)]
+        self.processors = [DarkflowDetectionProcessor(self.cam, self.background, roi=self.settings['darkflow_roi'],
+                                                      max_batch=self.settings['detector_batch'], **self.detector)]
+        self._sync_darkflow_roi()
+
+    def _sync_darkflow_roi(self):
+        '''Report whether roi was refused, since not every detector backend can run it'''
+        if self.settings['darkflow_roi'] and not self.processors[0].roi:
+            self.settings['darkflow_roi'] = False
+            self.settings['darkflow_roi_error'] = 'The {} backend cannot run roi crops'.format(self.detector['backend'])
+        else:
+            self.settings.pop('darkflow_roi_error', None)
 
     async def update_settings(self, settings):
 
@@ -154,6 +187,43 @@ class Controller:
 
                 # update our DB
                 self.templates = [x.label for x in self.img_db]
+        if 'keypoint_budget_auto' in settings or 'identify_target_ms' in settings:
+            if 'keypoint_budget_auto' in settings:
+                self.settings['keypoint_budget_auto'] = bool(settings['keypoint_budget_auto'])
+            if 'identify_target_ms' in settings:
+                self.settings['identify_target_ms'] = float(settings['identify_target_ms'])
+            if self.settings['mode'] == 'detection':
+                self.processors[0].budget.enabled = self.settings['keypoint_budget_auto']
+                self.processors[0].budget.target_ms = self.settings['identify_target_ms']
+        if 'identify_workers' in settings:
+            self.settings['identify_workers'] = max(0, int(settings['identify_workers']))
+            if self.settings['mode'] == 'detection':
+                # the pool is restarted with the new size on the next identification
+                self.processors[0].workers = self.settings['identify_workers']
+        if 'prefilter_k' in settings:
+            self.settings['prefilter_k'] = max(0, int(settings['prefilter_k']))
+            if self.settings['mode'] == 'detection':
+                self.processors[0].prefilter_k = self.settings['prefilter_k']
+        if 'template_size' in settings and max(0, int(settings['template_size'])) != self.settings['template_size']:
+            # templates and segments are shrunk to this longer side before extracting keypoints, 0 for no limit
+            self.settings['template_size'] = max(0, int(settings['template_size']))
+            if self.settings['mode'] == 'detection':
+                # the templates are re-extracted in the background
+                self.processors[0].set_template_size(self.settings['template_size'] or None)
+        if 'template_keypoints' in settings and max(0, int(settings['template_keypoints'])) != self.settings['template_keypoints']:
+            # strongest keypoints kept per template, 0 to keep them all
+            self.settings['template_keypoints'] = max(0, int(settings['template_keypoints']))
+            if self.settings['mode'] == 'detection':
+                self.processors[0].set_template_keypoints(self.settings['template_keypoints'] or None)
+        if 'detector_batch' in settings:
+            self.settings['detector_batch'] = max(1, int(settings['detector_batch']))
+            if self.settings['mode'] == 'darkflow':
+                self.processors[0].worker.max_batch = self.settings['detector_batch']
+        if 'darkflow_roi' in settings:
+            self.settings['darkflow_roi'] = bool(settings['darkflow_roi'])
+            if self.settings['mode'] == 'darkflow':
+                self.processors[0].roi = self.settings['darkflow_roi']
+                self._sync_darkflow_roi()
         #Set up the descriptor drop-downs
         if 'descriptor' in settings and (settings['descriptor'] != self.settings['descriptor'] or settings['descriptor_threshold'] != self.settings['descriptor_threshold']):
             desc = settings['descriptor']
@@ -193,11 +263,15 @@ class Controller:
                 desc = self.settings['descriptor']
 
             self.settings['descriptor'] = desc
+            # template features are computed in the background, so these return immediately
             if self.settings['mode'] == 'training':
                 self.processors[0].set_descriptor(self.descriptor)
+                self.img_db.set_descriptor(self.descriptor)
             elif self.settings['mode'] == 'detection':
+                # also updates the image db
                 self.processors[0].set_descriptor(self.descriptor)
-            self.img_db.set_descriptor(self.descriptor)
+            else:
+                self.img_db.set_descriptor(self.descriptor)
 
         # add our stream names now that everything has been added to the camera
         self.stream_names = self.cam.stream_names
@@ -220,6 +294,11 @@ class Controller:
         state = await self.update_state()
         #print('vision state is ', self.vision_state)
         if state is not None:
+            if self.startup_time is None:
+                self.startup_time = time.time() - self.start_time
+                print('First frame processed {:.2f}s after start'.format(self.startup_time))
+                if self.warm_detector:
+                    self.transform_processor.segmenter.warm()
             await self.pub_sock.send_multipart(['vision-update'.encode(), state.SerializeToString()])
             #exponential moving average of update frequency
             self.frequency = self.frequency * 0.8 +  0.2 / (time.time() - startTime)
@@ -325,8 +404,8 @@ class Controller:
 
 
 
-def init(video_filename, server_port, zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname, template_dir, output_video):
-    c = Controller(zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname)
+def init(video_filename, server_port, zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname, template_dir, output_video, detector=None, warm_detector=False, identify_workers=0, detector_batch=1):
+    c = Controller(zmq_sub_port, zmq_pub_port, zmq_projector_port, cc_hostname, detector, warm_detector, identify_workers, detector_batch)
     asyncio.ensure_future(c.handle_start(video_filename, server_port, template_dir, output_video))
     loop = asyncio.get_event_loop()
     loop.run_forever()
@@ -346,6 +425,12 @@ def main():
     parser.add_argument('--template-include', help='directory containing template images', dest='template_dir', required=True)
     parser.add_argument('--output-video', help='where to output video if desired', dest='output_video', default=None)
     parser.add_argument('--debug', help='enable async debugging tools', action='store_true')
+    parser.add_argument('--detector-backend', help='how to run the darkflow models', default='tensorflow', choices=list(DETECTOR_BACKENDS), dest='detector_backend')
+    parser.add_argument('--detector-threads', help='threads for the opencv detector backend', type=int, default=None, dest='detector_threads')
+    parser.add_argument('--detector-input-size', help='network input size for the opencv detector backend, a multiple of 32', type=int, default=None, dest='detector_input_size')
+    parser.add_argument('--detector-batch', help='frames queued while the darkflow detector is busy and run together as one batch, 1 to drop them', type=int, default=1, dest='detector_batch')
+    parser.add_argument('--identify-workers', help='processes identifying segments in parallel in detection mode, 0 to identify in the main process', type=int, default=0, dest='identify_workers')
+    parser.add_argument('--warm-detector', help='load the calibration model in the background once streaming, instead of when calibration starts', action='store_true', dest='warm_detector')
 
     args = parser.parse_args()
     if args.debug:
@@ -360,4 +445,41 @@ def main():
          args.zmq_projector_port,
          args.cc_hostname,
          args.template_dir,
-         args.output_video)
\ No newline at end of file
+         args.output_video,
+         detector_options(args),
+         args.warm_detector,
+         args.identify_workers,
+         args.detector_batch)
+
+def detector_options(args):
+    detector = {'backend': args.detector_backend}
+    if args.detector_backend == 'opencv':
+        detector['threads'] = args.detector_threads
+        detector['input_size'] = args.detector_input_size
+    return detector
+
+def benchmark_detector():
+    '''Compare the darkflow detector backends on the first frames of a video'''
+    parser = argparse.ArgumentParser(description='Compare darkflow detector backends on frames of a video')
+    parser.add_argument('video_filename', help='location of video')
+    parser.add_argument('--model', help='which darkflow model', default='reactor-tracking', choices=['reactor-tracking', 'dot-tracking'])
+    parser.add_argument('--frames', help='how many frames to use', type=int, default=50)
+    parser.add_argument('--threshold', help='detection threshold', type=float, default=0.1)
+    parser.add_argument('--detector-threads', help='threads for the opencv detector backend', type=int, default=None, dest='detector_threads')
+    parser.add_argument('--detector-input-size', help='network input size for the opencv detector backend', type=int, default=None, dest='detector_input_size')
+    parser.add_argument('--batch', help='frames per forward pass', type=int, default=1)
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.video_filename)
+    frames = []
+    while len(frames) < args.frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(frame)
+    cap.release()
+    if len(frames) == 0:
+        print('Could not read frames from {}'.format(args.video_filename))
+        return
+    opencv = {'threads': args.detector_threads, 'input_size': args.detector_input_size}
+    benchmark_darkflow(args.model, frames, threshold=args.threshold, options={'opencv': opencv}, batch=args.batch)
\ No newline at end of file
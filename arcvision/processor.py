@@ -1,8 +1,10 @@
-import asyncio, sys, cv2, os, time, pickle, traceback, pathlib
+import asyncio, sys, cv2, os, time, pickle, traceback, pathlib, math, types
 import numpy as np
 from numpy import linalg
 from .utils import *
-from multiprocessing import Process, Pipe, Lock
+from multiprocessing import Process, Pipe, Lock, get_context
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 SOURCE_ID = 0
 CONDITIONS_ID = 999
@@ -86,6 +88,33 @@ class Processor:
         pass
 
 
+class FrameCacheMixin:
+    '''For processors which keep work on the last frame they were asked about. Frames are identified
+       by the array itself or, since decorated frames are copies, by frame index'''
+    _cache_frame = None
+    _cache_ind = None
+
+    def _is_cached(self, frame, frame_ind):
+        if self._cache_frame is None:
+            return False
+        return frame is self._cache_frame or (frame_ind is not None and frame_ind == self._cache_ind)
+
+    def _set_cached(self, frame, frame_ind):
+        self._cache_frame = frame
+        self._cache_ind = frame_ind
+
+
+class DarkflowProcessor(Processor):
+    '''A processor whose network runs in self.worker, a DarkflowWorker'''
+    def close(self):
+        super().close()
+        self.worker.close()
+
+    def warm(self):
+        '''Load the model in the background now, rather than on the first frame that needs it'''
+        self.worker.start()
+
+
 class SpatialCalibrationProcessor(Processor):
     '''This will find a perspective transform that goes from our coordinate system
        to the projector coordinate system. Convergence in done by using point guess in next round with
@@ -233,7 +262,9 @@ class SpatialCalibrationProcessor(Processor):
 
     def _calibrate(self, frame, frame_ind):
         if frame_ind % (self.stay + self.delay) > self.delay:
-            for seg in self.segmenter.segments(frame):
+            # an asynchronous segmenter may still return results from before the dot moved
+            window_start = frame_ind - frame_ind % (self.stay + self.delay)
+            for seg in self.segmenter.segments(frame, frame_ind, min_ind=window_start):
                 #if(rect_color_channel(frame, seg) == self.channel):
                 p = rect_scaled_center(seg, frame)
                 self.points[self.index, :] = self.points[self.index, :] * self.counts[self.index] / (self.counts[self.index] + 1) + p / (self.counts[self.index] + 1)
@@ -425,24 +456,31 @@ class TrackerProcessor(Processor):
             return self._tracking
 
 
-    def __init__(self, camera, detector_stride, background, delete_threshold_period=1.0, stride=2, detectLines = True, readDials = True, do_tracking = True, alpha=0.8):
+    def __init__(self, camera, detector_stride, background, delete_threshold_period=1.0, stride=2, detectLines = True, readDials = True, do_tracking = True, alpha=0.8, motion_model=True, gate=9.21, pyramid_level=1):
+        '''motion_model: use a constant-velocity Kalman filter per track to predict positions every tick instead of exponential averaging with alpha.
+           gate: squared Mahalanobis distance below which a detection is associated with a track (9.21 is the 99% interval for 2 dof)
+           pyramid_level: number of pyrDown steps applied before optical flow and corner detection. Each level halves the resolution'''
         super().__init__(camera, ['track','line-segmentation'], stride)
         self._tracking = []
         self.do_tracking = do_tracking #this should only be False if we're using darkflow
         self.alpha = alpha
+        self.motion_model = motion_model
+        self.gate = gate
         self.labels = {}
         self.stride = stride
         self.ticks = 0
         if(do_tracking):
             self.optflow = cv2.DualTVL1OpticalFlow_create()#use dense optical flow to track
         self.detect_interval = 3
+        self.pyramid_level = pyramid_level
+        self.pyramid_scale = 2 ** pyramid_level
         self.prev_gray = None
         self.tracks = []
         self.min_pts_near = 4#the minimum number of points we need to say an object's center is here
         self.pts_dist_squared_th = int(75.0 / 2 / 720.0 * background.shape[0])**2
         self.feature_params = dict( maxCorners = 500,
                 qualityLevel = 0.3,
-                minDistance = 7,
+                minDistance = max(1, 7 // self.pyramid_scale),
                 blockSize = 7 )
         print('initializing trackerprocessor. background.shape is {} by {}'.format(background.shape[0], background.shape[1]))
         self.dist_th_upper = int(150.0 / 720.0 * background.shape[0])# distance upper threshold, in pixels
@@ -474,9 +512,9 @@ class TrackerProcessor(Processor):
         delete = []
 
         if(self.do_tracking):
-            smaller_frame = frame
-            smaller_frame = smaller_frame#4x downsampling
-            smaller_frame = cv2.cvtColor(smaller_frame, cv2.COLOR_BGR2GRAY)
+            smaller_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            for _ in range(self.pyramid_level):
+                smaller_frame = cv2.pyrDown(smaller_frame)
             gray = smaller_frame#cv2.UMat(smaller_frame)
             if(self.prev_gray is None):
                 self.prev_gray = gray#gray
@@ -488,8 +526,17 @@ class TrackerProcessor(Processor):
                 mask = np.zeros((smaller_frame.shape), dtype=np.uint8)#np.zeros_like(gray)
                 mask[:] = 255
                 self.tracks = np.float32(cv2.goodFeaturesToTrack(smaller_frame, mask=mask, **self.feature_params)).reshape(-1,2)
+                # keep corners in full resolution pixels so our thresholds still apply
+                self.tracks *= self.pyramid_scale
 
         for i,t in enumerate(self._tracking):
+            # where the object was last tick. Optical flow measures the motion from here, not from the prediction
+            previous = list(t['center_scaled'])
+            if self.motion_model:
+                # predict where the object is now, detections will correct it when they come in
+                t['filter'].predict()
+                t['filter'].state[:2] = np.clip(t['filter'].position, 0.0, 1.0)
+                t['center_scaled'] = t['filter'].position.tolist()
             old_center = t['center_scaled']
             t['connectedToPrimary'] = [] # list of tracked objects it is connected to as the primary/source node
             t['connectedToSecondary'] = []
@@ -501,11 +548,12 @@ class TrackerProcessor(Processor):
                 # check if the size dramatically changed.  if so, the object most likely was removed
                 # if not, rescale the tracked brect to the correct size
                 #print("t['center_scaled'] is {}".format(t['center_scaled']))
-                center_unscaled = (t['center_scaled'][0]*smaller_frame.shape[1] , t['center_scaled'][1]*smaller_frame.shape[0])
+                center_unscaled = (previous[0]*frame.shape[1] , previous[1]*frame.shape[0])
                 #print('center_unscaled is {} and smaller_frame.shape is {}'.format(center_unscaled, smaller_frame.shape))
                 #print('the dimensions of p1 are {}'.format(p1.shape))
-                a = int(center_unscaled[1])
-                b = int(center_unscaled[0])
+                # flow is computed on the pyramid level, so look it up there
+                a = min(int(previous[1]*smaller_frame.shape[0]), p1.shape[0] - 1)
+                b = min(int(previous[0]*smaller_frame.shape[1]), p1.shape[1] - 1)
                 flow_at_center = [p1[a][b][0], p1[a][b][1]]#get the flow computed at previous center of object
                 #flow_at_center = flow_at_center[::-1]#this is reversed for some reason..?
                 flow_at_center = scale_point(flow_at_center, smaller_frame)
@@ -513,14 +561,16 @@ class TrackerProcessor(Processor):
                 dist = distance_pts([[0,0], flow_at_center ])#this is the magnitude of the vector
                 # check if its new location is a reflection, or drastically far away
                 near_pts = 0
-                for pt in self.tracks:
-                    if(distance_pts([center_unscaled, pt]) <= self.pts_dist_squared_th):
-                        near_pts += 1
-                if (dist < .05 * max(smaller_frame.shape) and near_pts >= 5):#don't move more than 5% of the biggest dimension
+                if len(self.tracks) > 0:
+                    near_pts = np.sum(np.sqrt(np.sum((self.tracks - center_unscaled)**2, axis=1)) <= self.pts_dist_squared_th)
+                if (dist < .05 * max(frame.shape) and near_pts >= 5):#don't move more than 5% of the biggest dimension
                     #print('Updated distance is {}'.format(dist))
                     # rescale the brect to match the original area?
-                    t['center_scaled'][0] += flow_at_center[0]
-                    t['center_scaled'][1] += flow_at_center[1]
+                    measured = [previous[0] + flow_at_center[0], previous[1] + flow_at_center[1]]
+                    if self.motion_model:
+                        t['center_scaled'] = t['filter'].correct(measured).tolist()
+                    else:
+                        t['center_scaled'] = measured
                     t['observed'] = min(t['observed'] +2, self.max_obs_possible)
                 #put note about it
             # check obs counts
@@ -558,85 +608,75 @@ class TrackerProcessor(Processor):
         source_dist_thresh_upper = int(200.0 / 720.0 * frameSize[0])
         source_dist_thresh_lower = int(10.0 / 720.0 * frameSize[0])
         #print('source_dist_thresh_upper is {} and framesize[1] is {}'.format(source_dist_thresh_upper, frameSize[1]))
-        used_lines = []
+        lines = self.lineDetector.lines
+        centers = np.array([self._unscale_point(t['center_scaled'], frameSize) for t in self._tracking], dtype=np.float64).reshape(-1, 2)
+        line_angles_all = [np.pi/2.0 + np.arctan(line['slope']) for line in lines]#compare angles instead of slopes; bounded space from 0 to pi
+        angleThresh = np.pi/6.0
+        # bucket object centers and line endpoints on a grid the size of our upper distance threshold
+        # so we only consider pairs that could possibly be within dist_th_upper of each other
+        center_grid = SpatialHash(self.dist_th_upper)
+        for j,c in enumerate(centers):
+            center_grid.insert(j, c)
+        endpoint_grid = SpatialHash(self.dist_th_upper)
+        for k,line in enumerate(lines):
+            endpoint_grid.insert(k, line['endpoints'][0])
+            endpoint_grid.insert(k, line['endpoints'][1])
+
+        used_lines = set()
         for i,t1 in enumerate(self._tracking):
-            center = self._unscale_point(t1['center_scaled'], frameSize)
+            center = centers[i]
             # find all lines that have an endpoint near the center of this object
-            for k,line in enumerate(self.lineDetector.lines):
+            for k in endpoint_grid.query(center, self.dist_th_upper):
                 if k in used_lines:
                     continue # dont attempt to use this line if it is already associated with something
-
+                line = lines[k]
                 dist_ep1 = distance_pts((center, line['endpoints'][0]))
                 dist_ep2 = distance_pts((center, line['endpoints'][1]))
-                nearbyEndpointFound = False
-                #print('Distances for {} {} (position {}) to the endpoints are {} (position {}) and {} (position {})'.format(t1['label'], t1['id'], center, min(dist_ep1,dist_ep2), line['endpoints'][0], max(dist_ep1,dist_ep2), line['endpoints'][1]))
-                if (val_in_range(dist_ep1,self.dist_th_lower,self.dist_th_upper) or val_in_range(dist_ep2,self.dist_th_lower,self.dist_th_upper)):
-                    # we have a connection! use the endpoint that is further away to find another object thats close to it
-
-                    if (dist_ep1 <= dist_ep2):
-                        # use endpoint 2
-                        endpoint = line['endpoints'][1]
-                        #print('{} at {} is close to {} with a distance of {}, using {} to detect a connection'.format(t1['name'], center, dist_ep1, line['endpoints'][0], line['endpoints'][1]))
+                if not (val_in_range(dist_ep1,self.dist_th_lower,self.dist_th_upper) or val_in_range(dist_ep2,self.dist_th_lower,self.dist_th_upper)):
+                    continue
+                # we have a connection! use the endpoint that is further away to find another object thats close to it
+                endpoint = line['endpoints'][1] if dist_ep1 <= dist_ep2 else line['endpoints'][0]
+
+                # first check if the opposite endpoint is closest to the source
+                dist_source = distance_pts((source_position_unscaled, endpoint))
+                if (val_in_range(dist_source, source_dist_thresh_lower, source_dist_thresh_upper)):
+                    # connected to the source
+                    t1['connectedToSource'] = True
+                    used_lines.add(k)
+                    break
+
+                # only objects near the far endpoint can be connected by this line
+                candidates = np.array(center_grid.query(endpoint, self.dist_th_upper), dtype=np.int32)
+                if len(candidates) == 0:
+                    continue
+                # check if the slope between the two rxrs and that of the line are similar, and the distance to the endpoint, in bulk
+                angleDiff = np.abs(line_angles_all[k] - line_angles(center, centers[candidates]))#at most pi
+                dist2 = np.sqrt(np.sum((centers[candidates] - endpoint)**2, axis=1))
+                close = (angleDiff <= angleThresh) & (dist2 >= self.dist_th_lower) & (dist2 <= self.dist_th_upper)
+                for j in candidates[close]:
+                    t2 = self._tracking[j]
+                    if (t1['id'] == t2['id']):
+                        # don't attempt to find connections to yourself
+                        continue
+                    # also don't attempt a connection if these two are already connected
+                    if (((t2['id'], t2['label']) in t1['connectedToPrimary'])  or ((t2['id'], t2['label']) in t1['connectedToSecondary']) ):
+                        continue
+                    # its a connection! list this one as a connection, then break out of this loop
+                    # we can create directionality by having two lists
+                    # figure out which one is further to the left by checking the which x coordinate is greater (counter-intuitive, but the camera view is flipped)
+                    # if equal, use the y coordinate
+                    center2 = centers[j]
+                    if (center[0] > center2[0]) or (center[0] == center2[0] and center[1] < center2[1]):
+                        # first point is the primary
+                        t1['connectedToPrimary'].append((t2['id'], t2['label']))
+                        t2['connectedToSecondary'].append((t1['id'], t1['label']))
                     else:
-                        endpoint = line['endpoints'][0]
-                        #print('{} at {} is close to {} with a distance of {}, using {} to detect a connection'.format(t1['name'], center, dist_ep2, line['endpoints'][1], line['endpoints'][0]))
-
-                    # first check if the opposite endpoint is closest to the source
-                    dist_source = distance_pts((source_position_unscaled, endpoint))
-                    if (val_in_range(dist_source, source_dist_thresh_lower, source_dist_thresh_upper)):
-                        # connected to the source
-                        t1['connectedToSource'] = True
-                        #print('Item {} is connected to the source'.format(t1['label']))
-                        used_lines.append(k)
-                        break
-                    #else:
-                        #print('Distance from source to endpoint was {}'.format(dist_source))
-                    # iterate over all tracked objects again to see if the end of this line is close enough to any other object
-                    for j,t2 in enumerate(self._tracking):
-                        #print('made it this FAR!!! {} {}'.format(t1['id'], t2['id']))#now this DOES print for whatever reason...
-                        if (t1['id'] == t2['id']):
-                            # don't attempt to find connections to yourself
-                            continue
-                        # also don't attempt a connection if these two are already connected
-                        if (((t2['id'], t2['label']) in t1['connectedToPrimary'])  or ((t2['id'], t2['label']) in t1['connectedToSecondary']) ):
-                            continue
-
-                        # check if the slope between the two rxrs and that of the line are similar
-                        center2 = self._unscale_point(t2['center_scaled'], frameSize)
-                        #print('the distance between objects {} {} and {} {} is {}'.format(t1['label'],t1['id'], t2['label'],t2['id'], distance_pts((center, center2))))#now this line is printing again...
-                        lineSlope = line['slope']
-                        lineAngle = np.pi/2.0 + np.arctan(lineSlope)#compare angles instead of slopes; bounded space from 0 to pi
-                        rxrSlope, intercept = line_from_endpoints((center, center2)) if center[1] > center2[1] else line_from_endpoints((center2, center))
-                        rxrAngle = np.pi/2.0 + np.arctan(rxrSlope)
-                        angleDiff = abs(lineAngle - rxrAngle)#at most pi
-                        #print('line angle is {} deg, rxr angle is {} deg, and angle % difference is {}'.format(lineAngle * 180./np.pi, rxrAngle * 180./np.pi, angleDiff/np.pi))#print in degrees for legibility
-                        #sys.stdout.flush()
-                        angleThresh = np.pi/6.0
-                        if angleDiff > angleThresh:
-                            continue
-                        dist2 = distance_pts((center2, endpoint))
-                        if (val_in_range(dist2, self.dist_th_lower,self.dist_th_upper)):
-                            # its a connection! list this one as a connection, then break out of this loop
-                            # we can create directionality by having two lists
-                            # figure out which one is further to the left by checking the which x coordinate is greater (counter-intuitive, but the camera view is flipped)
-                            # if equal, use the y coordinate
-                            if (center[0] > center2[0]) or (center[0] == center2[0] and center[1] < center2[1]):
-                                # first point is the primary
-                                t1['connectedToPrimary'].append((t2['id'], t2['label']))
-                                t2['connectedToSecondary'].append((t1['id'], t1['label']))
-                            else:
-                                t2['connectedToPrimary'].append((t1['id'],t1['label']))
-                                t1['connectedToSecondary'].append((t2['id'], t2['label']))
-
-                            #print('{} is connected to {}'.format(t1['name'], t2['name'])) #debug message
-                            #print('Item {} is connected to {}'.format(t1['label'], t2['label']))
-
-                            # make sure that the line used to discern this connection is not used again
-                            used_lines.append(k)
-                            break
-                        else:
-                            pass
-                            #print('dist from object {} was {}'.format(t2['name'], dist2))
+                        t2['connectedToPrimary'].append((t1['id'],t1['label']))
+                        t1['connectedToSecondary'].append((t2['id'], t2['label']))
+
+                    # make sure that the line used to discern this connection is not used again
+                    used_lines.add(k)
+                    break
 
 
 
@@ -678,9 +718,11 @@ class TrackerProcessor(Processor):
 
         return  frame#cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-    def track(self, frame, brect, poly, label, id_num, temperature = 298):
+    def track(self, frame, brect, poly, label, id_num, temperature = 298, age=0):
         '''
         Track a newly found object (returns True), or return False for an existing object.
+        age is how many frames ago the detection was made. With the motion model an existing
+        object's detection is moved forward by its velocity and trusted less the older it is.
         '''
 
         center = poly_scaled_center(poly, frame) if (poly is not None and cv2.contourArea(poly) < rect_area(brect)) else rect_scaled_center(brect, frame)
@@ -689,16 +731,27 @@ class TrackerProcessor(Processor):
             temperature = self.dialReader.temperature
         else:
             temperature = 298
+        name = '{}-{}'.format(label, id_num)
+        # the filters are predicted once per tick
+        steps = age / self.stride
         #we need to make sure we don't have an existing object here
-        for t in self._tracking:
-            if  t['name'] == '{}-{}'.format(label, id_num) or intersecting_rects(t['brect'], brect): #found already existing reactor
-                t['observed'] = self.ticks_per_obs
+        existing = self._associate(name, brect, center, steps)
+        if existing is not None: #found already existing reactor
+            t = existing
+            t['observed'] = self.ticks_per_obs
+            if self.motion_model and steps > 0:
+                now = t['filter'].extrapolate(center, steps)
+                brect = (int(round(brect[0] + (now[0] - center[0]) * frame.shape[1])),
+                         int(round(brect[1] + (now[1] - center[1]) * frame.shape[0])), brect[2], brect[3])
+                noise = t['filter'].measurement_noise[0,0] * (1 + steps)
+                t['center_scaled'] = t['filter'].correct(now, noise).tolist()
+            elif self.motion_model:
+                t['center_scaled'] = t['filter'].correct(center).tolist()
+            else:
                 t['center_scaled'] = [t['center_scaled'][0] * (1.0 - self.alpha) + center[0] * self.alpha, t['center_scaled'][1] * (1.0 - self.alpha) + center[1] * self.alpha] #do exponential averaging of position to cut down jitters
-                t['brect'] = brect
-                return False
-
+            t['brect'] = brect
+            return False
 
-        name = '{}-{}'.format(label, id_num)
         #tracker = cv2.DualTVL1OpticalFlow_create()
         #status = tracker.init(cv2.UMat(frame), brect)
 
@@ -722,12 +775,33 @@ class TrackerProcessor(Processor):
                      'id': id_num,
                      'connectedToPrimary': [],
                      'weight':[temperature,1]}
+        if self.motion_model:
+            track_obj['filter'] = ConstantVelocityFilter(track_obj['center_scaled'])
         self._tracking.append(track_obj)
         return True
 
-class SegmentProcessor(Processor):
-    def __init__(self, camera, background, stride, max_segments, max_rectangle=0.25, channel=None, hsv_delta=[100, 110, 16], name=None):#TODO: mess with this max_rectangle and see if that helps the big brect isues
-        '''Pass stride = -1 to only process on request'''
+    def _associate(self, name, brect, center, steps=0):
+        '''Find the existing track for a detection. Same name always matches, otherwise
+           use the gate on the predicted position (or overlapping rects without a motion model).
+           steps is the age of the detection in ticks'''
+        best, best_dist = None, self.gate
+        for t in self._tracking:
+            if t['name'] == name:
+                return t
+            if not self.motion_model:
+                if best is None and intersecting_rects(t['brect'], brect):
+                    best = t
+                continue
+            dist = t['filter'].mahalanobis(t['filter'].extrapolate(center, steps))
+            if dist <= best_dist:
+                best, best_dist = t, dist
+        return best
+
+class SegmentProcessor(FrameCacheMixin, Processor):
+    def __init__(self, camera, background, stride, max_segments, max_rectangle=0.25, channel=None, hsv_delta=[100, 110, 16], name=None, scale=1.0, refine=True):#TODO: mess with this max_rectangle and see if that helps the big brect isues
+        '''Pass stride = -1 to only process on request
+           scale: resolution relative to the camera which the background mask is computed at
+           refine: when scale < 1, refine the rescaled rectangles using the full resolution frame'''
         if(name is None):
             self.name_str = ''
         else:
@@ -743,7 +817,10 @@ class SegmentProcessor(Processor):
                                   self.name_str + 'boxes',
                                   self.name_str + 'watershed'
                                   ], max(1, stride), name=name)
-        self.rect_iter = range(0)
+        self.rect_iter = []
+        self.scale = scale
+        self.refine = refine
+        self._threshold = 0
         self.background = background
         self.max_segments = max_segments
         self.max_rectangle = max_rectangle
@@ -766,6 +843,24 @@ class SegmentProcessor(Processor):
             print('range of color hsv', self.hsv_min, hsv, self.hsv_max)
 
 
+    @property
+    def background(self):
+        return self._background
+
+    @background.setter
+    def background(self, background):
+        self._background = background
+        if background is not None:
+            self._scaled_background = self._downscale(background)
+        else:
+            self._scaled_background = None
+        self.invalidate()
+
+    def invalidate(self):
+        '''Drop the cached segmentation. Must be called if anything other than the frame changes the result'''
+        self._set_cached(None, None)
+        self._intermediates = {}
+
     async def process_frame(self, frame, frame_ind):
         '''we only process on request'''
         if self.own_process:
@@ -773,52 +868,128 @@ class SegmentProcessor(Processor):
             return
         return
 
-    def _process_frame(self, frame, frame_ind):
-        bg = self._filter_background(frame)
+    def _process_frame(self, frame, frame_ind=None):
+        if self._is_cached(frame, frame_ind):
+            return
+        small_frame = self._downscale(frame)
+        # keep every step around so decorate_frame can show them without redoing the work
+        stages = {'frame': small_frame}
+        bg = self._filter_background(small_frame, stages)
         dist_transform = self._filter_distance(bg)
-        self.rect_iter = self._filter_contours(dist_transform, frame.shape)
+        stages['distance'] = dist_transform
+        # areas at low resolution are too coarse to rank by, so only keep the largest once rescaled
+        rects = self._filter_contours(dist_transform, small_frame.shape, min_area=250 * self.scale**2,
+                                      truncate=self.scale == 1)
+        self.rect_iter = []
+        for r in rects:
+            r = self._rescale_rect(r, frame)
+            # pieces of one segment at low resolution can refine to the same rectangle
+            if r not in self.rect_iter:
+                self.rect_iter.append(r)
+        self.rect_iter.sort(key=lambda r: r[2] * r[3], reverse=True)
+        del self.rect_iter[self.max_segments:]
+        self._intermediates = stages
+        self._set_cached(frame, frame_ind)
         return
 
-    def segments(self, frame = None):
+    def segments(self, frame = None, frame_ind = None, min_ind = None):
+        '''Segment the frame, unless it was already segmented. Without a frame the last segments are returned.
+           min_ind is accepted for compatibility with asynchronous segmenters; these segments are never older than frame'''
         if frame is not None:
-            self._process_frame(frame, 0)
+            self._process_frame(frame, frame_ind)
         yield from self.rect_iter
 
 
-    def _filter_background(self, frame, name = ''):
+    def _downscale(self, frame):
+        if self.scale == 1:
+            return frame
+        # subsample rather than average, so the diff keeps the noise statistics the thresholds expect
+        return cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+
+    def _filter_sizes(self, scale):
+        '''median blur, blur and morphology kernel sizes for a given resolution'''
+        return max(3, int(7 * scale) | 1), max(1, int(round(5 * scale))), max(2, int(round(4 * scale)))
+
+    def _rescale_rect(self, rect, frame):
+        '''Take a rectangle found at our segmentation scale back to the resolution of frame'''
+        if self.scale == 1:
+            return rect
+        rect = (int(rect[0] / self.scale), int(rect[1] / self.scale),
+                int(math.ceil(rect[2] / self.scale)), int(math.ceil(rect[3] / self.scale)))
+        if self.refine and self.background is not None:
+            rect = self._refine_rect(frame, rect)
+        return rect
+
+    def _refine_rect(self, frame, rect):
+        '''Redo the background subtraction at full resolution, but only in a window around rect.
+           The threshold is the one chosen for the whole frame at our scale'''
+        median_size, blur_size, kernel_size = self._filter_sizes(1.0)
+        # cover the rounding from our scale plus the reach of the filters, so nothing touches the window edge
+        pad = int(math.ceil(1 / self.scale)) + median_size // 2 + blur_size // 2 + 3 * kernel_size
+        x0, y0 = max(0, rect[0] - pad), max(0, rect[1] - pad)
+        x1 = min(frame.shape[1], rect[0] + rect[2] + pad)
+        y1 = min(frame.shape[0], rect[1] + rect[3] + pad)
+        window = (x0, y0, x1 - x0, y1 - y0)
+        try:
+            view, background = rect_view(frame, window), rect_view(self.background, window)
+        except ValueError:
+            return rect
+        gray = self._filter_diff(view, background, 1.0, {})
+        _, mask = cv2.threshold(gray, self._threshold, 255, cv2.THRESH_BINARY)
+        mask = self._filter_noise(mask, 1.0, {})
+        # the padding can catch the edges of neighbors, so only keep our segment
+        _, contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return rect
+        r = cv2.boundingRect(max(contours, key=cv2.contourArea))
+        return (r[0] + x0, r[1] + y0, r[2], r[3])
+
+    def _filter_background(self, frame, stages = None, scale = None):
+        '''stages: optional dict which is filled with each intermediate image, keyed by stream name
+           scale: the resolution of frame relative to the camera, which defaults to our segmentation scale'''
+        if stages is None:
+            stages = {}
+        if scale is None:
+            scale = self.scale
+        background = self._scaled_background if scale == self.scale else self.background
+        gray = self._filter_diff(frame, background, scale, stages)
+        ret, bg = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        if scale == self.scale:
+            # kept for refining rectangles at full resolution
+            self._threshold = ret
+        #bg = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        #                                cv2.THRESH_BINARY_INV,11,2)
+        if np.mean(cv2.mean(bg)) > 255 // 2:
+           bg = cv2.subtract(bg, 255)
+        stages['bg-thresh'] = bg
+        return self._filter_noise(bg, scale, stages)
 
+    def _filter_diff(self, frame, background, scale, stages):
+        '''Blurred grayscale difference of frame from background, with filters sized for the resolution scale'''
+        median_size, blur_size, _ = self._filter_sizes(scale)
         img = frame#.copy()
         gray = cv2.UMat(img)
         #print('frame is type {} and self.background is type {}'.format(frame, self.background))
-        if(self.background is not None):
-            gray = diff_blur(self.background, frame, False)
-        if name.find('bg-subtract') != -1:
-            return gray
+        if(background is not None):
+            gray = diff_blur(background, frame, False, median_size)
+        stages['bg-subtract'] = gray
         if self.channel is None or True:
             if len(img.shape) == 3 and img.shape[2] == 3:
                 gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
         else:
             gray = gray#cv2.inRange(gray, self.hsv_min, self.hsv_max)
-        gray = cv2.blur(gray, (5,5))
-        if name.find('bg-filter-blur') != -1:
-            return gray
-        ret, bg = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        #bg = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        #                                cv2.THRESH_BINARY_INV,11,2)
-        if np.mean(cv2.mean(bg)) > 255 // 2:
-           bg = cv2.subtract(bg, 255)
-
-        if name.find('bg-thresh') != -1:
-            return bg
-        # noise removal
-        kernel = np.ones((4,4),np.uint8)
+        gray = cv2.blur(gray, (blur_size, blur_size))
+        stages['bg-filter-blur'] = gray
+        return gray
+
+    def _filter_noise(self, bg, scale, stages):
+        '''Noise removal of a thresholded mask, with a kernel sized for the resolution scale'''
+        _, _, kernel_size = self._filter_sizes(scale)
+        kernel = np.ones((kernel_size,kernel_size),np.uint8)
         bg = cv2.erode(bg, kernel, iterations = 1)
-        if name.find('bg-erode') != -1:
-            return bg
+        stages['bg-erode'] = bg
         bg = cv2.morphologyEx(bg,cv2.MORPH_OPEN,kernel, iterations = 1)
-        if name.find('bg-open') != -1:
-            return bg
-
+        stages['bg-open'] = bg
         return bg
 
     def _filter_distance(self, frame):
@@ -848,7 +1019,8 @@ class SegmentProcessor(Processor):
         rect = cv2.boundingRect(c)
         return rect[2] * rect[3]
 
-    def _filter_contours(self, frame, frame_shape, return_contour=False):
+    def _filter_contours(self, frame, frame_shape, return_contour=False, min_area=250, truncate=True):
+        '''Bounding rectangles (or contours) of the segments, largest first. Stops after max_segments if truncate'''
         _, contours, _ = cv2.findContours(frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         contours.sort(key = self.sort_key, reverse=True)
         rects = [cv2.boundingRect(c) for c in contours]
@@ -857,7 +1029,7 @@ class SegmentProcessor(Processor):
         for c,r in zip(contours, rects):
             #flip around our rectangle
             # exempt small or large rectangles
-            if(r[2] * r[3] < 250 or \
+            if(r[2] * r[3] < min_area or \
                 r[2] * r[3] / frame_shape[0] / frame_shape[1] > self.max_rectangle ):
                 continue
             if not return_contour:
@@ -865,15 +1037,14 @@ class SegmentProcessor(Processor):
             else:
                 yield c
             segments += 1
-            if(segments == self.max_segments):
+            if(truncate and segments == self.max_segments):
                 break
 
 
     def _watershed(self, frame, markers):
         ws_markers = cv2.watershed(frame, markers)
         segments = 0
-        for i in range(1, np.max(ws_markers)):
-            pixels = np.argwhere(ws_markers == i)
+        for i, pixels in label_pixels(ws_markers, 1, np.max(ws_markers)):
             rect = cv2.boundingRect(pixels)
             #flip around our rectangle
             rect = (rect[1], rect[0], rect[3], rect[2])
@@ -886,12 +1057,17 @@ class SegmentProcessor(Processor):
             if(segments == self.max_segments):
                 break
 
-    def polygon(self, frame, rect = None):
+    def polygon(self, frame, rect = None, frame_ind = None):
         '''
             rect: an optional view which will limit the frame
+            frame_ind: index of frame, used to re-use the segmentation of this frame
         '''
-        bg = self._filter_background(frame)
-        dist_transform = self._filter_distance(bg)
+        if self.scale == 1:
+            self._process_frame(frame, frame_ind)
+            dist_transform = self._intermediates['distance']
+        else:
+            # polygons need full resolution
+            dist_transform = self._filter_distance(self._filter_background(frame, scale=1.0))
         # filter herre
         if rect is not None:
             dist_transform = rect_view(dist_transform, rect)
@@ -901,7 +1077,7 @@ class SegmentProcessor(Processor):
         ws_markers = cv2.watershed(frame, markers)
 
         #sort based on size
-        pixels = [np.flip(np.argwhere(ws_markers == i), axis=1) for i in range(1, np.max(ws_markers))]
+        pixels = [np.flip(p, axis=1) for _, p in label_pixels(ws_markers, 1, np.max(ws_markers))]
         def key(x):
             r = cv2.boundingRect(x)
             return r[2] * r[3]
@@ -932,24 +1108,35 @@ class SegmentProcessor(Processor):
         return result
 
     async def decorate_frame(self, frame, name):
-        if self.name_str not in name:
+        if name not in self.streams:
             return frame
-        bg = self._filter_background(frame, name)
-
-
-        dist_transform = self._filter_distance(bg)
-        if 'distance' in name:
-            return dist_transform
+        # draw from the last real segmentation, only segment here if nobody has asked yet
+        if not self._intermediates:
+            self._process_frame(self.camera.frame, self.camera.frame_ind)
+        stage = name[len(self.name_str):]
+        if stage in self._intermediates:
+            return self._full_size(self._intermediates[stage], frame)
 
         if 'boxes' in name:
-            for rect in self._filter_contours(dist_transform, frame.shape):
+            for rect in self.rect_iter:
                 draw_rectangle(frame, rect, (255, 255, 0), 1)
         if 'watershed' in name:
-            markers = self._filter_ws_markers(dist_transform)
-            ws_markers = cv2.watershed(frame, markers)
+            # not under the stream's own name, the labels are not an image to show
+            if 'watershed-markers' not in self._intermediates:
+                markers = self._filter_ws_markers(self._intermediates['distance'])
+                self._intermediates['watershed-markers'] = cv2.watershed(self._intermediates['frame'], markers)
+            ws_markers = self._full_size(self._intermediates['watershed-markers'], frame)
             frame[ws_markers == -1] = (255, 0, 0)
         return frame#cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
+    def _full_size(self, img, frame):
+        '''Bring an intermediate image back to the size of frame for display'''
+        if isinstance(img, cv2.UMat):
+            img = img.get()
+        if img.shape[:2] != frame.shape[:2]:
+            img = cv2.resize(img, frame.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+        return img
+
 
 class TrainingProcessor(Processor):
 
@@ -972,6 +1159,7 @@ class TrainingProcessor(Processor):
         self.polys = []
         self.poly = np.array([[0,0], [0,0]])
         self.descriptor = descriptor
+        self.keypoint_cache = KeypointCache()
         self._objects = []
 
     def close(self):
@@ -982,13 +1170,13 @@ class TrainingProcessor(Processor):
         self.descriptor = desc
 
     async def process_frame(self, frame, frame_ind):
-        self.segments = list(self.segmenter.segments(frame))
+        self.segments = list(self.segmenter.segments(frame, frame_ind))
         self.rect_len = len(self.segments)
         if self.rect_index >= 0 and self.rect_index < len(self.segments):
             self.rect = self.segments[self.rect_index]#stretch_rectangle(self.segments[self.rect_index], frame)
 
         # index 1 is poly
-        self.polys = [x[0] for x in self.segmenter.polygon(frame, self.rect)]
+        self.polys = [x[0] for x in self.segmenter.polygon(frame, self.rect, frame_ind)]
         self.poly_len = len(self.polys)
         if self.poly_index >= 0 and self.poly_index < len(self.polys):
             self.poly = self.polys[self.poly_index]
@@ -1000,7 +1188,8 @@ class TrainingProcessor(Processor):
         if name == 'training':
 
 
-            kp, _ = keypoints_view(self.descriptor, frame, self.rect)
+            # keypoints of the camera frame, not of what has been drawn on it so far
+            kp, _ = self.keypoint_cache.get(self.descriptor, self.camera.frame, self.rect, self.camera.frame_ind)
             cv2.drawKeypoints(frame, kp, frame, color=(32,32,32), flags=0)
 
             for r in self.segments:
@@ -1041,9 +1230,10 @@ class TrainingProcessor(Processor):
 class DetectionProcessor(Processor):
     '''Detects query images in frame. Uses async to spread out computation. Cannot handle replicas of an object in frame'''
     def __init__(self, camera, background, img_db, descriptor, stride=3,
-                 threshold=0.8, template_size=256, min_match=6,
+                 threshold=0.8, template_size=None, min_match=6,
                  weights=[3, -1, -1, -10, 5], max_segments=10,
-                 track=True):
+                 track=True, segment_scale=1.0, prefilter_k=0, workers=0,
+                 template_keypoints=None, template_grid=4, budget=None):
 
         #we have a specific order required
         #set-up our tracker
@@ -1055,36 +1245,78 @@ class DetectionProcessor(Processor):
 
 
         #then our segmenter
-        self.segmenter = SegmentProcessor(camera, background, -1, max_segments)
+        # segment_scale below 1 segments faster, but its segments can still differ from those at full resolution
+        self.segmenter = SegmentProcessor(camera, background, -1, max_segments, scale=segment_scale)
         #then us
         super().__init__(camera, ['keypoints', 'identify'], stride)
 
 
         self._ready = True
         self.features = {}
+        # shared by identification and decoration
+        self.keypoint_cache = KeypointCache()
+        # keypoints and matches of segments which have not changed since they were identified
+        self.segment_cache = SegmentCache()
         self.threshold = threshold#this is the percentage of distance similarity
         self.min_match = min_match
         self.weights = weights
         self.stretch_boxes=1.5
+        # templates and segments are shrunk to at most this size before keypoints are extracted,
+        # which bounds the number of features whatever the camera resolution. None for no limit
+        self.template_size = template_size
+        # strongest keypoints kept per template, spread over a template_grid x template_grid grid (None for all),
+        # and the controller for the number kept per segment
+        self.template_keypoints = template_keypoints
+        self.template_grid = template_grid
+        self.budget = budget if budget is not None else KeypointBudget()
+        # only this many templates, ranked by color, are kept from the index lookup and verified per segment. 0 to keep all
+        self.prefilter_k = prefilter_k
         self.track = track
         self.templates = img_db
         self.stride = stride
+        # processes used to identify segments in parallel, or 0 to identify on the event loop.
+        # None for one per spare cpu
+        if workers is None:
+            workers = (os.cpu_count() or 1) - 1
+        self.workers = workers
+        self._pool = None
+        self._pool_state = None
+        self._pool_manager = None
+        self._pool_templates = None
 
         # Initiate descriptors
         self.desc = descriptor
-        FLANN_INDEX_KDTREE = 0
-        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-        search_params = dict(checks=50)
-        self.matcher = cv2.FlannBasedMatcher(index_params,search_params)#cv2.BFMatcher()
 
         #create color gradient
         N = len(img_db)
         for i,t in enumerate(self.templates):
             rgba = [int(x * 255) for x in np.random.random(size=4)]
             t.color = rgba[:-1]
-            if t.keypoints is None:
-                t.keypoints = self.desc.detect(t.img)
-            t.keypoints, t.features = self.desc.compute(t.img, t.keypoints)
+        self.templates.compute_features(self.desc, self.template_size)
+        self.template_index = self._build_index()
+        self._descriptor_request = 0
+        # the settings of the newest request, which may still be computing
+        self._requested = {'desc': self.desc, 'template_size': self.template_size,
+                           'template_keypoints': self.template_keypoints}
+        # keep the index current as templates are captured
+        self.templates.listeners.append(self._add_template)
+
+    def _build_index(self):
+        '''The index (and its matcher) depend on the descriptor type, so this must be rebuilt whenever desc changes'''
+        index = TemplateIndex(self.desc)
+        for t in self.templates:
+            self._index_add(index, t, t.keypoints, t.features, self.template_keypoints)
+        return index
+
+    def _index_add(self, index, t, kp, des, template_keypoints):
+        kp, des = strongest_keypoints(kp, des, template_keypoints, self.template_grid)
+        return index.add(t, kp, des, color_signature(t.img, t.poly))
+
+    def _add_template(self, t):
+        rgba = [int(x * 255) for x in np.random.random(size=4)]
+        t.color = rgba[:-1]
+        t.keypoints, t.features = self.templates.template_features(t, self.desc, max_size=self.template_size)
+        self._index_add(self.template_index, t, t.keypoints, t.features, self.template_keypoints)
 
     @property
     def objects(self):
@@ -1097,11 +1329,51 @@ class DetectionProcessor(Processor):
         super().close()
         self.segmenter.close()
         self.tracker.close()
+        self.templates.listeners.remove(self._add_template)
+        self._close_pool()
 
     def set_descriptor(self, desc):
+        '''Switch descriptor in the background. Identification continues with the current
+           descriptor and index until features for every template are ready'''
+        return self._request(desc=desc)
+
+    def set_template_size(self, template_size):
+        '''Change template_size in the background, like set_descriptor'''
+        return self._request(template_size=template_size)
+
+    def set_template_keypoints(self, template_keypoints):
+        '''Change template_keypoints in the background, like set_descriptor'''
+        return self._request(template_keypoints=template_keypoints)
+
+    def _request(self, **changes):
+        self._requested.update(changes)
+        return asyncio.ensure_future(self._set_descriptor(**self._requested))
+
+    async def _set_descriptor(self, desc, template_size, template_keypoints):
+        self._descriptor_request += 1
+        request = self._descriptor_request
+        key = features_key(desc, template_size)
+        results = await self.templates.compute_features_async(desc, max_size=template_size)
+        index = TemplateIndex(desc)
+        for t, kp, des in results:
+            self._index_add(index, t, kp, des, template_keypoints)
+        await asyncio.get_event_loop().run_in_executor(self.templates.executor, index.train)
+        # superseded by a later descriptor
+        if request != self._descriptor_request:
+            return False
+        # no awaits from here, so frames see either the old or the new descriptor
+        self.templates.apply_features(key, results)
+        computed = set(id(r[0]) for r in results)
+        for t in self.templates:
+            # captured while we were computing
+            if id(t) not in computed:
+                t.keypoints, t.features = self.templates.template_features(t, desc, key, template_size)
+                self._index_add(index, t, t.keypoints, t.features, template_keypoints)
         self.desc = desc
-        for i, t in enumerate(self.templates):
-            t.keypoints, t.features = self.desc.detectAndCompute(t.img, None)
+        self.template_size = template_size
+        self.template_keypoints = template_keypoints
+        self.template_index = index
+        return True
 
     async def process_frame(self, frame, frame_ind):
         if(self._ready):
@@ -1114,9 +1386,9 @@ class DetectionProcessor(Processor):
         if name != 'keypoints' and name != 'identify':
             return frame
 
-        # draw key points
-        for rect in self.segmenter.segments(frame):
-            kp,_ = keypoints_view(self.desc, frame, rect)
+        # draw key points, using the segments already found for this frame
+        for rect in self.segmenter.segments(self.camera.frame, self.camera.frame_ind):
+            kp,_ = self.keypoint_cache.get(self.desc, self.camera.frame, rect, self.camera.frame_ind, self.template_size)
             if(kp is not None):
                 cv2.drawKeypoints(frame, kp, frame, color=(32,32,32), flags=0)
             # draw the rectangle that we use for kp
@@ -1135,110 +1407,307 @@ class DetectionProcessor(Processor):
 
         return  frame#cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
+    def _skip_ids(self, frame_ind):
+        '''Templates already in play are only searched for every other stride'''
+        if frame_ind % (self.stride*2) == 0:
+            return set()
+        return set([o['id'] for o in self.objects])
+
+    def _identify_pool(self):
+        '''Process pool whose workers hold the current template index. Templates added to the index are pushed
+           to the workers, the pool is only recreated when the index is replaced or its settings change'''
+        if self.workers == 0:
+            self._close_pool()
+            return None
+        index = self.template_index
+        params = {'threshold': self.threshold, 'min_match': self.min_match,
+                  'weights': self.weights, 'prefilter_k': self.prefilter_k, 'template_size': self.template_size}
+        state = (index, self.workers, repr(params))
+        if self._pool is None or self._pool_state != state:
+            self._close_pool()
+            # fresh interpreters, as a fork would copy the camera, event loop and any threads
+            ctx = get_context('spawn')
+            self._pool_manager = ctx.Manager()
+            self._pool_templates = self._pool_manager.list(self._worker_templates(index, 0))
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=_init_identify_worker,
+                                             initargs=(descriptor_config(self.desc), self._pool_templates, params))
+            self._pool_state = state
+        elif len(self._pool_templates) < len(index):
+            # workers pick these up before their next segment
+            self._pool_templates.extend(self._worker_templates(index, len(self._pool_templates)))
+        return self._pool
+
+    def _worker_templates(self, index, start):
+        '''The templates of index from start on, with only what verify_matches reads from a template'''
+        return [(types.SimpleNamespace(label=t.label, id=t.id, poly=t.poly, color=t.color), pack_keypoints(kp), features, signature)
+                for t, kp, features, signature in list(zip(index.templates, index.keypoints, index.features, index.signatures))[start:]]
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool_manager.shutdown()
+        self._pool = None
+        self._pool_state = None
+
+    def _tracked_id(self, frame, rect):
+        '''The template id of the tracked object whose position is inside rect, closest to its center if several'''
+        best, best_dist = None, None
+        cx, cy = rect[0] + rect[2] / 2, rect[1] + rect[3] / 2
+        for o in self.objects:
+            if 'brect' not in o:
+                continue
+            x, y = o['center_scaled'][0] * frame.shape[1], o['center_scaled'][1] * frame.shape[0]
+            if not (rect[0] <= x < rect[0] + rect[2] and rect[1] <= y < rect[1] + rect[3]):
+                continue
+            dist = (x - cx)**2 + (y - cy)**2
+            if best is None or dist < best_dist:
+                best, best_dist = o['id'], dist
+        return best
+
+    def _track_features(self, frame, rect, rect_features):
+        if self.track:
+            for name, f in rect_features.items():
+                self.tracker.track(frame, rect, f['poly'], name, f['id'])
+
     async def _identify_features(self, frame, frame_ind):
         self._ready = False
+        start = time.time()
         #make new features object
         features = {}
+        # number of keypoints per segment used in matching
+        limit = self.budget.limit
+        n_keypoints = 0
 
         found_feature = False
-        for rect in self.segmenter.segments(frame):
-            kp, des = keypoints_view(self.desc, frame, rect)
-            if(des is not None and len(des) > 3):
-                rect_features = await self._process_frame_view(frame, kp, des, rect, frame_ind)
-                if len(rect_features) > 0:
-                    found_feature = True
-                    best = max(rect_features, key=lambda x: rect_features[x]['score'])
-                    if best in features:
-                        features[best].append(rect_features[best])
-                    else:
-                        features[best] = [rect_features[best]]
+        skip = self._skip_ids(frame_ind)
+        # results with templates skipped are incomplete, so are not kept
+        complete = len(skip) == 0
+        index = self.template_index
+        # where each template is in the index, to look-up the template of a track
+        positions = {t.id: i for i,t in enumerate(index.templates)}
+        pool = self._identify_pool()
+        loop = asyncio.get_event_loop()
+        pending = []
+        all_features = []
+        self.segment_cache.begin()
+        for rect in self.segmenter.segments(frame, frame_ind):
+            fingerprint, cached = self.segment_cache.get(frame, rect, index)
+            # a segment on a tracked object is first only checked against that object's template
+            tracked = positions.get(self._tracked_id(frame, rect)) if cached is None else None
+            if cached is not None:
+                kp, des, rect_features = cached
+                n_keypoints += len(kp)
+                self.keypoint_cache.put(self.desc, frame, rect, frame_ind, (kp, des), self.template_size)
+                # keep the tracker informed, as matching would have
+                self._track_features(frame, rect, rect_features)
+            elif pool is not None:
+                # the workers extract keypoints too, so send them the pixels
+                signature = color_signature(rect_view(frame, rect)) if self.prefilter_k > 0 else None
+                stretched = stretch_rectangle(rect, frame)
+                pending.append((rect, fingerprint, loop.run_in_executor(pool, _identify_in_worker, len(index),
+                    rect_view(frame, stretched), stretched[:2], rect, signature, skip, tracked, limit)))
+                continue
+            else:
+                kp, des = self.keypoint_cache.get(self.desc, frame, rect, frame_ind, self.template_size)
+                n_keypoints += len(kp)
+                rect_features = {}
+                if(des is not None and len(des) > 3):
+                    rect_features = await self._process_frame_view(frame, *strongest_keypoints(kp, des, limit),
+                                                                   rect, frame_ind, tracked)
+                if complete and index is self.template_index:
+                    self.segment_cache.put(rect, fingerprint, (kp, des, rect_features), index)
+            all_features.append(rect_features)
+
+        for rect, fingerprint, future in pending:
+            try:
+                packed, des, rect_features = await future
+            except BrokenProcessPool:
+                print('Identification worker died, restarting pool')
+                self._close_pool()
+                continue
+            kp = unpack_keypoints(packed)
+            n_keypoints += len(kp)
+            self.keypoint_cache.put(self.desc, frame, rect, frame_ind, (kp, des), self.template_size)
+            self._track_features(frame, rect, rect_features)
+            if complete and index is self.template_index:
+                self.segment_cache.put(rect, fingerprint, (kp, des, rect_features), index)
+            all_features.append(rect_features)
+
+        for rect_features in all_features:
+            if len(rect_features) > 0:
+                found_feature = True
+                best = max(rect_features, key=lambda x: rect_features[x]['score'])
+                if best in features:
+                    features[best].append(rect_features[best])
+                else:
+                    features[best] = [rect_features[best]]
+        self.segment_cache.end()
         if found_feature:
             self.features = features
+        best = [max(rf.values(), key=lambda f: f['score']) for rf in all_features if len(rf) > 0]
+        self.budget.update((time.time() - start) * 1000, n_keypoints, len(all_features), len(best),
+                           [f['score'] for f in best], [f['precision'] for f in best])
         self._ready = True
 
-    async def _process_frame_view(self, frame, kp, des, bounds, frame_ind):
+    async def _process_frame_view(self, frame, kp, des, bounds, frame_ind, tracked=None):
         '''This method tries to run the calculation over multiple loops.
+            The segment is matched against all templates at once, then templates with enough votes are verified.
+            If tracked is the index position of the template of an object tracked in bounds, that template
+            alone is tried first and the search over all templates only happens if it is not verified.
             The _ready is to in lieu of a callback on completion'''
         self._ready = False
         features = {}
-        for t in self.templates:
-            # check if t is already in play by its id number
-            # if yes, check the frame index and see if this index is 2x the stride.
-            templateInPlay = False
-            for o in self.objects:
-                if o['id'] == t.id:
-                    templateInPlay = True
-
-            if (templateInPlay and (frame_ind % (self.stride*2) != 0)):
-                continue
-
-            try:
-                template = t.img
-                name = t.label
-                descriptors = t.keypoints, t.features
-
-                if(type(descriptors[1]) != np.float32):
-                    des1 = np.float32(descriptors[1])
-                if(type(des) != np.float32):
-                    des2 = np.float32(des)
-                matches = self.matcher.knnMatch(des1, des2, k=2)
-                # store all the good matches as per Lowe's ratio test.
-                good = []
-                if(len(matches) > 1): #not sure how this happens
-                    for m,n in matches:
-                        if m.distance < self.threshold * n.distance:
-                            good.append(m)
-                # check if we have enough good points
-                if len(good) > self.min_match:
-
-                    # look-up actual x,y keypoints
-                    src_pts = np.float32([ descriptors[0][m.queryIdx].pt for m in good ]).reshape(-1,1,2)
-                    dst_pts = np.float32([ kp[m.trainIdx].pt for m in good ]).reshape(-1,1,2)
-
-                    # use homography to find matrix transform between them
-                    M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,3.0)
-                    if M is None:
-                        continue
-
-                    src_poly = np.float32(t.poly).reshape(-1,1,2)
-                    dst_poly = cv2.perspectiveTransform(src_poly,M)
-                    dst_brect = cv2.boundingRect(dst_poly)
-
-                    # check if the polygon is actually good
-                    area = max(0.01, cv2.contourArea(dst_poly))
-                    perimter = max(0.01, cv2.arcLength(dst_poly, True))
-                    score = len(good) / len(des) * self.weights[0] + \
-                            perimter / area * self.weights[1] + \
-                            (dst_brect[2] / bounds[2] - 1 + dst_brect[3] /  bounds[3] - 1) * self.weights[2] + \
-                            (dst_brect[2] * dst_brect[3] < 5) * self.weights[3] + \
-                            self.weights[4]
-                    if score > 0:
-                        features[name] = { 'color': t.color, 'poly': np.int32(dst_poly),
-                            'kp': np.int32([kp[m.trainIdx].pt for m in good]).reshape(-1,2),
-                            'kpcolor': [(255, 255, 255, 128) for x in good],
-                            'score': score, 'rect': bounds}
-                        # register it with our tracker
-                        if self.track:
-                            self.tracker.track(frame, bounds, np.int32(dst_poly), name, t.id)
-            except cv2.error:
-                #not enough points
-                await asyncio.sleep(0)
-                continue
-
+        # rank templates by color first, so descriptor matching only sees likely ones
+        signature = color_signature(rect_view(frame, bounds)) if self.prefilter_k > 0 else None
+        for t, feature in search_templates(self.template_index, kp, des, bounds, signature, self._skip_ids(frame_ind),
+                                           tracked, self.threshold, self.min_match, self.weights, self.prefilter_k):
+            if feature is not None:
+                features[t.label] = feature
+                # register it with our tracker
+                if self.track:
+                    self.tracker.track(frame, bounds, feature['poly'], t.label, t.id)
             #cede control
             await asyncio.sleep(0)
         return features
 
-class DarkflowSegmentProcessor(Processor):
-    def __init__(self, camera, stride=1, threshold=0.1):
-        self.tfnet = load_darkflow('dot-tracking', gpu=1.0, threshold=threshold)
+
+def search_templates(index, kp, des, bounds, signature, skip, tracked, threshold, min_match, weights, prefilter_k):
+    '''Match a segment's keypoints against the templates of index, then verify the ones with enough votes.
+       If tracked is the index position of the template of an object tracked in bounds, that template
+       alone is tried first and the search over the templates only happens if it is not verified.
+       With a color signature and prefilter_k, only the prefilter_k closest templates by color are matched and verified.
+       Yields (template, feature) like verify_matches, so callers on the event loop can cede control'''
+    searches = [([tracked], ())] if tracked is not None else []
+    candidates = None
+    if signature is not None and prefilter_k > 0:
+        candidates = index.candidates(signature, prefilter_k)
+    searches.append((candidates, skip))
+    for candidates, search_skip in searches:
+        try:
+            votes = index.match(des, threshold, candidates)
+        except cv2.error:
+            #not enough points
+            votes = {}
+        found = False
+        for t, feature in verify_matches(index, votes, kp, len(des), bounds, min_match, weights, search_skip):
+            found = found or feature is not None
+            yield t, feature
+        if found:
+            return
+
+
+def verify_matches(index, votes, kp, n_des, bounds, min_match, weights, skip=()):
+    '''Check the matches of each template that has enough votes with a homography, and score it.
+       Yields (template, feature), where feature is None if the template was rejected.
+       A generator, so that callers on the event loop can cede control between templates'''
+    for i, good in votes.items():
+        t = index.templates[i]
+        # check if t is already in play by its id number
+        if t.id in skip:
+            continue
+        # check if we have enough good points
+        if len(good) <= min_match:
+            continue
+        feature = None
+        try:
+            # look-up actual x,y keypoints
+            src_pts = np.float32([ index.keypoints[i][m.trainIdx].pt for m in good ]).reshape(-1,1,2)
+            dst_pts = np.float32([ kp[m.queryIdx].pt for m in good ]).reshape(-1,1,2)
+
+            # use homography to find matrix transform between them
+            M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC,3.0)
+            if M is not None:
+                src_poly = np.float32(t.poly).reshape(-1,1,2)
+                dst_poly = cv2.perspectiveTransform(src_poly,M)
+                dst_brect = cv2.boundingRect(dst_poly)
+
+                # check if the polygon is actually good
+                area = max(0.01, cv2.contourArea(dst_poly))
+                perimter = max(0.01, cv2.arcLength(dst_poly, True))
+                score = len(good) / n_des * weights[0] + \
+                        perimter / area * weights[1] + \
+                        (dst_brect[2] / bounds[2] - 1 + dst_brect[3] /  bounds[3] - 1) * weights[2] + \
+                        (dst_brect[2] * dst_brect[3] < 5) * weights[3] + \
+                        weights[4]
+                if score > 0:
+                    feature = { 'color': t.color, 'poly': np.int32(dst_poly),
+                        'kp': np.int32([kp[m.queryIdx].pt for m in good]).reshape(-1,2),
+                        'kpcolor': [(255, 255, 255, 128) for x in good],
+                        'score': score, 'rect': bounds, 'id': t.id,
+                        'precision': float(np.mean(mask)) if mask is not None else 0.0}
+        except cv2.error:
+            #not enough points
+            pass
+        yield t, feature
+
+# state of an identification worker process, set-up by _init_identify_worker
+_identify_worker = {}
+
+def _init_identify_worker(config, templates, params):
+    '''templates is a shared list, which the parent appends templates to as they are added'''
+    desc = create_descriptor(config)
+    index = TemplateIndex(desc)
+    _identify_worker.update(desc=desc, index=index, templates=templates, **params)
+    _sync_identify_worker(len(templates))
+    index.train()
+
+def _sync_identify_worker(n_templates):
+    '''Add the templates the parent has added since this worker last looked, up to n_templates'''
+    w = _identify_worker
+    if len(w['index']) < n_templates:
+        for t, packed, features, signature in w['templates'][len(w['index']):n_templates]:
+            w['index'].add(t, unpack_keypoints(packed), features, signature)
+
+def _identify_in_worker(n_templates, view, offset, bounds, signature, skip, tracked=None, limit=None):
+    '''Runs in a worker process. Same as extracting keypoints for a segment with keypoints_view
+       then search_templates, as DetectionProcessor._process_frame_view does, except the tracker is left to the caller.
+       n_templates is the size of the parent's index. Returns packed keypoints, descriptors and the features found'''
+    _sync_identify_worker(n_templates)
+    w = _identify_worker
+    kp, des = detect_and_compute(w['desc'], view, w['template_size'])
+    for k in kp:
+        k.pt = (offset[0] + k.pt[0], offset[1] + k.pt[1])
+    features = {}
+    if des is None or len(des) <= 3:
+        return pack_keypoints(kp), des, features
+    # match with the strongest, but return them all for the caller's caches
+    all_kp, all_des = kp, des
+    kp, des = strongest_keypoints(kp, des, limit)
+    for t, feature in search_templates(w['index'], kp, des, bounds, signature, skip, tracked,
+                                       w['threshold'], w['min_match'], w['weights'], w['prefilter_k']):
+        if feature is not None:
+            features[t.label] = feature
+    return pack_keypoints(all_kp), all_des, features
+
+class DarkflowSegmentProcessor(FrameCacheMixin, DarkflowProcessor):
+    def __init__(self, camera, stride=1, threshold=0.1, backend='tensorflow', **backend_options):
+        # inference runs in another process, so segments may come from a slightly older frame
+        self.worker = DarkflowWorker('dot-tracking', threshold=threshold, backend=backend, **backend_options)
+        # rectangles of the newest result, so callers and decoration don't redo them
+        self._result = None
+        self._result_segments = []
         super().__init__(camera, ['segment'], stride)
 
-    def segments(self, frame):
-        return self._process_frame(frame)
+    def segments(self, frame, frame_ind=None, min_ind=None):
+        '''Segments from the newest finished inference. A frame is sent for inference at most once, if the worker is free.
+           With min_ind, results computed on frames before min_ind are ignored'''
+        if not self._is_cached(frame, frame_ind):
+            self.worker.submit(frame, frame_ind)
+            self._set_cached(frame, frame_ind)
+        result_ind, segments = self._latest_segments()
+        if min_ind is not None and (result_ind is None or result_ind < min_ind):
+            return []
+        return list(segments)
+
+    def _latest_segments(self):
+        '''The frame_ind of the newest result and its rectangles'''
+        result_ind, result = self.worker.latest()
+        if result is not self._result:
+            self._result_segments = self._segments(result)
+            self._result = result
+        return result_ind, self._result_segments
 
-    def _process_frame(self, frame):
-        result = self.tfnet.return_predict(frame) #get a dict of detected items with labels and confidences.
+    def _segments(self, result):
         sorted_result = sorted(result, key=lambda x: x['confidence'], reverse=True)
         segments = [darkflow_to_rect(x) for x in sorted_result]
         return segments
@@ -1248,14 +1717,35 @@ class DarkflowSegmentProcessor(Processor):
 
     async def decorate_frame(self, frame, name):
         if name == 'segment':
-            for s in self.segments(frame):
+            # don't submit, the frame has been drawn on
+            for s in self._latest_segments()[1]:
                 draw_rectangle(frame, s, (255, 255, 0), 1)
+        return frame
 
-class DarkflowDetectionProcessor(Processor):
+class DarkflowDetectionProcessor(DarkflowProcessor):
     '''Detects query images in frame. Uses async to spread out computation. Cannot handle replicas of an object in frame'''
     def __init__(self, camera, background, stride=3,
-                 threshold=0.1, track=True):
-        self.tfnet = load_darkflow('reactor-tracking', gpu=1.0, threshold=threshold)
+                 threshold=0.1, track=True, max_batch=1, roi=False, full_period=30, roi_pad=0.5,
+                 motion_threshold=0.001, backend='tensorflow', **backend_options):
+        '''roi: between full frame searches, only run the network on crops around tracked objects. The crops keep
+           the scale of the full frame, so the network input shrinks with them. It is refused by backends
+           with a fixed input size, such as tensorflow.
+           They are tiled into one image, so the cost grows with the number of objects rather than the frame area.
+           A full frame search is done every full_period frames, when nothing is tracked, or when more than
+           motion_threshold of the frame away from tracked objects changed since the last processed frame.
+           roi_pad is how far a crop extends past its object, as a fraction of the object size'''
+        # frames that arrive while inference is busy are batched, up to max_batch, rather than dropped
+        self.worker = DarkflowWorker('reactor-tracking', max_batch=max_batch, threshold=threshold, backend=backend, **backend_options)
+        self.backend = backend
+        self.track = track
+        self.roi = roi
+        self.full_period = full_period
+        self.roi_pad = roi_pad
+        self.motion_threshold = motion_threshold
+        self.network_size = darkflow_input_size('reactor-tracking', backend_options.get('input_size'))
+        self._last_full = None
+        self._motion = False
+        self._prev_small = None
         self.id_i = 1000#skip over 0 thru 999
         #we have a specific order required
         #set-up our tracker
@@ -1267,7 +1757,6 @@ class DarkflowDetectionProcessor(Processor):
 
         #then us
         super().__init__(camera, ['identify'], stride)
-        self.track = track
         self.stride = stride
 
     @property
@@ -1276,22 +1765,138 @@ class DarkflowDetectionProcessor(Processor):
             return []
         return self.tracker.objects
 
+    @property
+    def roi(self):
+        return self._roi
+
+    @roi.setter
+    def roi(self, roi):
+        '''Crops are run at the scale of the full frame, so the backend must take a smaller network input
+           rather than magnify them. It also needs tracking, to know where to crop'''
+        if roi and not DETECTOR_BACKENDS[self.backend].resizable_input:
+            print('The {} backend has a fixed input size, which would magnify roi crops. Searching full frames'.format(self.backend))
+            roi = False
+        self._roi = bool(roi) and self.track
+
     def close(self):
         super().close()
         self.tracker.close()
 
     async def process_frame(self, frame, frame_ind):
-        result = self.tfnet.return_predict(frame)#get a dict of detected items with labels and confidences.
-        for item in result:
-            brect = darkflow_to_rect(item)
-            label = item['label']
-            id_num = self.id_i
-            new_obj = self.tracker.track(frame, brect, None, label, id_num)
-            if(new_obj):
-                self.id_i += 1
+        # never wait for inference, use whatever has finished since last time, oldest first
+        if self.roi:
+            self._submit_rois(frame, frame_ind)
+        else:
+            self.worker.submit(frame, frame_ind)
+        for key, result in self.worker.take():
+            # roi searches are keyed by the frame index and where the crops came from (None for the whole frame)
+            result_ind, tiles = key if isinstance(key, tuple) else (key, None)
+            # frames since the one inference ran on, so the tracker can move detections forward
+            age = max(0, frame_ind - result_ind)
+            for item in result:
+                brect = darkflow_to_rect(item)
+                if tiles is not None:
+                    brect = self._from_mosaic(brect, tiles, frame)
+                    if brect is None:
+                        continue
+                label = item['label']
+                id_num = self.id_i
+                new_obj = self.tracker.track(frame, brect, None, label, id_num, age=age)
+                if(new_obj):
+                    self.id_i += 1
 
         return
 
+    def _submit_rois(self, frame, frame_ind):
+        crops, tile = self._crops(frame)
+        if self._motion_outside(frame, crops) > self.motion_threshold:
+            self._motion = True
+        full = (len(crops) == 0 or self._motion or self._last_full is None or
+                frame_ind - self._last_full >= self.full_period)
+        if not full:
+            mosaic, tiles, input_size = self._mosaic(frame, crops, tile)
+            # no cheaper than looking at everything
+            full = input_size[0] * input_size[1] >= self.network_size[0] * self.network_size[1]
+        if full:
+            inputs, tiles, input_size = [(frame, (frame_ind, None))], None, None
+        else:
+            inputs = [(mosaic, (frame_ind, tiles))]
+        if self.worker.submit_batch(inputs, input_size) and full:
+            self._last_full = frame_ind
+            self._motion = False
+
+    def _crops(self, frame):
+        '''Rectangles around the tracked objects, centered on where they are predicted to be now, and their size
+           in network pixels at the scale of the full frame. They all have the same size, a multiple of 32.
+           Objects well inside an earlier rectangle don't get their own'''
+        if len(self.tracker._tracking) == 0:
+            return [], None
+        sx = self.network_size[0] / frame.shape[1]
+        sy = self.network_size[1] / frame.shape[0]
+        # big enough in network pixels for the largest object and its padding
+        need = max(max(t['brect'][2] * sx, t['brect'][3] * sy) for t in self.tracker._tracking) * (1 + 2 * self.roi_pad)
+        tile = int(math.ceil(need / 32)) * 32
+        if tile >= min(self.network_size):
+            return [], None
+        w, h = int(round(tile / sx)), int(round(tile / sy))
+        crops = []
+        for t in self.tracker._tracking:
+            cx = t['center_scaled'][0] * frame.shape[1]
+            cy = t['center_scaled'][1] * frame.shape[0]
+            # the object with half of its padding
+            rx = t['brect'][2] * (1 + self.roi_pad) / 2
+            ry = t['brect'][3] * (1 + self.roi_pad) / 2
+            if any(c[0] <= cx - rx and cx + rx <= c[0] + c[2] and c[1] <= cy - ry and cy + ry <= c[1] + c[3] for c in crops):
+                continue
+            x = int(min(max(0, cx - w / 2), frame.shape[1] - w))
+            y = int(min(max(0, cy - h / 2), frame.shape[0] - h))
+            crops.append((x, y, w, h))
+        return crops, tile
+
+    def _mosaic(self, frame, crops, tile):
+        '''Tile the crops into one image so they take a single forward pass, since a pass has a fixed cost however
+           small its input. Tiles line up with the network's 32 pixel cells. Returns the image, each crop with
+           where it was put, and the network input size'''
+        w, h = crops[0][2:]
+        cols = int(math.ceil(math.sqrt(len(crops))))
+        rows = int(math.ceil(len(crops) / cols))
+        mosaic = np.zeros((rows * h, cols * w, frame.shape[2]), dtype=frame.dtype)
+        tiles = []
+        for i, c in enumerate(crops):
+            x, y = (i % cols) * w, (i // cols) * h
+            mosaic[y:y + h, x:x + w] = rect_view(frame, c)
+            tiles.append((c, (x, y)))
+        return mosaic, tiles, (cols * tile, rows * tile)
+
+    def _from_mosaic(self, brect, tiles, frame, margin=2):
+        '''Map a detection in the mosaic back to the frame. None if it is not inside its tile, or touches a tile edge
+           that is inside the frame, since then it is likely only part of an object'''
+        cx, cy = brect[0] + brect[2] / 2, brect[1] + brect[3] / 2
+        for crop, (x, y) in tiles:
+            if not (x <= cx < x + crop[2] and y <= cy < y + crop[3]):
+                continue
+            left = margin + 1 if crop[0] > 0 else 0
+            top = margin + 1 if crop[1] > 0 else 0
+            right = crop[2] - 1 - (margin + 1 if crop[0] + crop[2] < frame.shape[1] else 0)
+            bottom = crop[3] - 1 - (margin + 1 if crop[1] + crop[3] < frame.shape[0] else 0)
+            bx, by = brect[0] - x, brect[1] - y
+            if bx < left or by < top or bx + brect[2] > right or by + brect[3] > bottom:
+                return None
+            return (bx + crop[0], by + crop[1], brect[2], brect[3])
+        return None
+
+    def _motion_outside(self, frame, crops, scale=8, threshold=25):
+        '''Fraction of the frame away from the crops that changed since the last processed frame'''
+        small = cv2.resize(frame, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA)
+        prev, self._prev_small = self._prev_small, small
+        if prev is None or prev.shape != small.shape:
+            return 0.
+        # in any channel, a colored object can have the same brightness as the table
+        changed = cv2.absdiff(small, prev).max(axis=2) > threshold
+        for x, y, w, h in crops:
+            changed[y // scale:(y + h) // scale + 1, x // scale:(x + w) // scale + 1] = False
+        return np.count_nonzero(changed) / changed.size
+
     async def decorate_frame(self, frame, name):
         for i,item in enumerate(self.tracker._tracking):
             draw_rectangle(frame, item['brect'], (255, 0, 0), 1)
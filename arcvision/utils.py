@@ -1,6 +1,164 @@
-import cv2, glob, pickle, os, copy, hashlib, math, pkg_resources
+import cv2, glob, pickle, os, copy, hashlib, math, pkg_resources, asyncio, threading, json, time
+import multiprocessing
 import numpy as np
-from darkflow.net.build import TFNet
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+# getters that make up a descriptor's configuration, for those descriptors which have them
+DESCRIPTOR_PARAMETERS = ['getThreshold', 'getHessianThreshold', 'getDescriptorType', 'getDescriptorSize',
+                         'getDescriptorChannels', 'getNOctaves', 'getNOctaveLayers', 'getOctaves',
+                         'getDiffusivity', 'getExtended', 'getUpright', 'getPatternScale', 'getMaxPoints']
+
+def descriptor_config(descriptor):
+    '''The type and parameters of a feature descriptor as a dict'''
+    config = {'name': descriptor.getDefaultName()}
+    for getter in DESCRIPTOR_PARAMETERS:
+        if hasattr(descriptor, getter):
+            try:
+                config[getter[3:]] = getattr(descriptor, getter)()
+            except cv2.error:
+                pass
+    return config
+
+def create_descriptor(config):
+    '''Create a new feature descriptor from the output of descriptor_config'''
+    name = config['name'].split('.')[-1]
+    if name == 'SURF':
+        descriptor = cv2.xfeatures2d.SURF_create()
+    else:
+        descriptor = getattr(cv2, name + '_create')()
+    for k,v in config.items():
+        setter = 'set' + k
+        if k != 'name' and hasattr(descriptor, setter):
+            try:
+                getattr(descriptor, setter)(v)
+            except cv2.error:
+                pass
+    return descriptor
+
+_thread_state = threading.local()
+def thread_descriptor(config, key):
+    '''Descriptors are not safe to share between threads and some (BRISK) are slow
+       to create, so keep one per thread for each configuration'''
+    if getattr(_thread_state, 'key', None) != key:
+        _thread_state.descriptor = create_descriptor(config)
+        _thread_state.key = key
+    return _thread_state.descriptor
+
+def descriptor_key(descriptor):
+    '''Short hash identifying a descriptor type and its parameters'''
+    config = descriptor_config(descriptor)
+    return hashlib.sha1(repr(sorted(config.items())).encode()).hexdigest()[:16]
+
+def features_key(descriptor, max_size=None):
+    '''Identifies features computed with descriptor on images limited to max_size'''
+    key = descriptor_key(descriptor)
+    if max_size is None:
+        return key
+    return '{}-{}'.format(key, max_size)
+
+def detect_and_compute(descriptor, img, max_size=None):
+    '''detectAndCompute, on a copy of img shrunk so its longer side is at most max_size.
+       Keypoints are returned in the coordinates of img, so the number of features is bounded
+       without the caller having to know about the scaling'''
+    scale = 1.0
+    if max_size is not None and max(img.shape[:2]) > max_size:
+        scale = max_size / max(img.shape[:2])
+        img = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                         interpolation=cv2.INTER_AREA)
+    kp, des = descriptor.detectAndCompute(img, None)
+    if scale != 1.0:
+        for k in kp:
+            k.pt = (k.pt[0] / scale, k.pt[1] / scale)
+            k.size = k.size / scale
+    return kp, des
+
+def strongest_keypoints(kp, des, n=None, grid=None):
+    '''Keep the n keypoints (and their descriptor rows) with the highest response.
+       With grid, the extent of the keypoints is split into grid x grid cells which take turns
+       giving up their strongest remaining keypoint, so the kept keypoints are spread out'''
+    if n is None or des is None or len(kp) <= n:
+        return kp, des
+    response = np.array([k.response for k in kp])
+    if grid is None or grid <= 1:
+        order = np.argsort(-response, kind='stable')[:n]
+    else:
+        pts = np.array([k.pt for k in kp])
+        low = pts.min(axis=0)
+        span = np.maximum(pts.max(axis=0) - low, 1e-6)
+        cells = np.minimum((pts - low) / span * grid, grid - 1).astype(np.int32)
+        cell = cells[:,1] * grid + cells[:,0]
+        # rank of each keypoint by strength within its cell
+        rank = np.empty(len(kp), dtype=np.int32)
+        counts = np.zeros(grid * grid, dtype=np.int32)
+        for i in np.argsort(-response, kind='stable'):
+            rank[i] = counts[cell[i]]
+            counts[cell[i]] += 1
+        # every cell's strongest first, then every cell's second strongest...
+        order = np.lexsort((-response, rank))[:n]
+    return [kp[i] for i in order], des[order]
+
+class KeypointBudget:
+    '''Feedback control of how many keypoints per segment are used in matching.
+       When enabled, the limit shrinks while identification takes longer than target_ms
+       per stride and grows back towards max_keypoints when there is slack.
+       When disabled the limit is fixed at max_keypoints (None for no limit)'''
+    # upper limit in auto mode when max_keypoints is None
+    CEILING = 1000
+
+    def __init__(self, enabled=False, target_ms=50, max_keypoints=None, min_keypoints=50, alpha=0.2):
+        self.enabled = enabled
+        self.target_ms = target_ms
+        self.max_keypoints = max_keypoints
+        self.min_keypoints = min_keypoints
+        self.alpha = alpha # for the moving averages in stats
+        self._limit = self._ceiling()
+        self.stats = {'identify_ms': 0, 'keypoints_per_segment': 0, 'identified_fraction': 0,
+                      'mean_score': 0, 'match_precision': 0, 'keypoint_limit': self.limit}
+        # averages which have had a sample, the rest start from their first one rather than from 0
+        self._sampled = set()
+
+    def _ceiling(self):
+        return self.max_keypoints if self.max_keypoints is not None else KeypointBudget.CEILING
+
+    @property
+    def limit(self):
+        if not self.enabled:
+            return self.max_keypoints
+        return int(self._limit)
+
+    def update(self, elapsed_ms, keypoints, segments, identified, scores, precisions=()):
+        '''Record one identification stride. keypoints is the total extracted over segments,
+           identified is how many segments were matched to a template, scores their scores
+           and precisions the fraction of their matches which were homography inliers'''
+        def average(name, value):
+            if name not in self._sampled:
+                self._sampled.add(name)
+                self.stats[name] = value
+            else:
+                self.stats[name] = self.stats[name] * (1 - self.alpha) + value * self.alpha
+        average('identify_ms', elapsed_ms)
+        if segments > 0:
+            average('keypoints_per_segment', keypoints / segments)
+            average('identified_fraction', identified / segments)
+        if len(scores) > 0:
+            average('mean_score', sum(scores) / len(scores))
+        if len(precisions) > 0:
+            average('match_precision', sum(precisions) / len(precisions))
+        if self.enabled:
+            if self.stats['identify_ms'] > self.target_ms:
+                self._limit = max(self.min_keypoints, self._limit * 0.8)
+            elif self.stats['identify_ms'] < 0.6 * self.target_ms:
+                self._limit = min(self._ceiling(), self._limit * 1.1)
+        self.stats['keypoint_limit'] = self.limit
+
+def pack_keypoints(keypoints):
+    '''cv2.KeyPoint cannot be pickled, so convert to tuples'''
+    return [(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id) for k in keypoints]
+
+def unpack_keypoints(packed):
+    return [cv2.KeyPoint(*p) for p in packed]
 
 class ImageDB:
     '''Class which stores pre-processed, labeled images used in identification'''
@@ -37,9 +195,19 @@ class ImageDB:
 
     # --- end Image Class
 
-    def __init__(self, template_dir, load=True):
+    FEATURE_CACHE = '.feature-cache'
+
+    def __init__(self, template_dir, load=True, workers=None):
         self.images = []
         self.template_dir = template_dir
+        # descriptor key of the keypoints/features currently on the images
+        self.features_key = None
+        # feature extraction runs here so it does not block the event loop.
+        # opencv releases the GIL, so threads are enough
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._features_request = 0
+        # callables which are given each newly stored image
+        self.listeners = []
         # load any images
         if load:
             self._load(template_dir)
@@ -73,9 +241,104 @@ class ImageDB:
     def get_img(self, label):
         return filter(lambda s: s.label == label, self.images)
 
-    def set_descriptor(self, descriptor):
+    def set_descriptor(self, descriptor, max_size=None):
+        '''Compute features for descriptor in the background. The current features stay on
+           the images until all the new ones are ready. Returns the future doing the work'''
+        return asyncio.ensure_future(self._set_descriptor(descriptor, max_size))
+
+    async def _set_descriptor(self, descriptor, max_size=None):
+        self._features_request += 1
+        request = self._features_request
+        key = features_key(descriptor, max_size)
+        results = await self.compute_features_async(descriptor, max_size=max_size)
+        # a later request supersedes this one
+        if request != self._features_request:
+            return False
+        self.apply_features(key, results)
+        if self.features_key == key:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.prune_feature_cache, key)
+        return True
+
+    async def compute_features_async(self, descriptor, images=None, max_size=None):
+        '''Compute keypoints and features for images (default all) on the executor.
+           Returns a list of (image, keypoints, features) without changing the images'''
+        if images is None:
+            images = list(self.images)
+        key = features_key(descriptor, max_size)
+        config = descriptor_config(descriptor)
+        config_key = descriptor_key(descriptor)
+        loop = asyncio.get_event_loop()
+        work = lambda img: self.template_features(img, thread_descriptor(config, config_key), key, max_size)
+        features = await asyncio.gather(*[loop.run_in_executor(self.executor, work, img) for img in images])
+        return [(img, kp, des) for img, (kp, des) in zip(images, features)]
+
+    def apply_features(self, key, results):
+        '''Swap in the output of compute_features_async'''
+        for img, kp, des in results:
+            img.keypoints, img.features = kp, des
+        computed = set(id(r[0]) for r in results)
+        if all(id(img) in computed for img in self.images):
+            self.features_key = key
+        else:
+            # images were added while computing
+            self.features_key = None
+
+    def compute_features(self, descriptor, max_size=None):
+        '''Set keypoints and features of every image for descriptor, with images limited to max_size.
+           Uses the on-disk cache, so only templates which have not been seen with this descriptor are computed'''
+        key = features_key(descriptor, max_size)
+        if key == self.features_key:
+            return
         for img in self:
-            img.keypoints = descriptor.detect(img.img)
+            img.keypoints, img.features = self.template_features(img, descriptor, key, max_size)
+        self.features_key = key
+        self.prune_feature_cache(key)
+
+    def prune_feature_cache(self, key):
+        '''Remove cached features which are not for one of the current images with key, so the cache
+           does not keep growing as templates and descriptor settings change. Returns the number removed'''
+        keep = set(os.path.basename(self._feature_path(img, key)) for img in list(self.images))
+        cache_dir = os.path.join(self.template_dir, ImageDB.FEATURE_CACHE)
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return 0
+        removed = 0
+        for name in names:
+            if name.endswith('.features') and name not in keep:
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def _feature_path(self, img, key):
+        content = hashlib.sha256(np.ascontiguousarray(img.img).tobytes() + repr(img.img.shape).encode()).hexdigest()
+        return os.path.join(self.template_dir, ImageDB.FEATURE_CACHE, '{}-{}.features'.format(content[:32], key))
+
+    def template_features(self, img, descriptor, key=None, max_size=None):
+        '''Keypoints and features of one image, loaded from the cache if present'''
+        if key is None:
+            key = features_key(descriptor, max_size)
+        path = self._feature_path(img, key)
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            return unpack_keypoints(data['keypoints']), data['features']
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            pass
+        keypoints, features = detect_and_compute(descriptor, img.img, max_size)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so concurrent readers never see a partial file
+            tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'keypoints': pack_keypoints(keypoints), 'features': features}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Could not write feature cache {}: {}'.format(path, e))
+        return keypoints, features
 
 
     def store_img(self, img, label, poly, keypoints = None, processed_img = None, rel_path = None):
@@ -92,6 +355,7 @@ class ImageDB:
         if len(path.split('.jpg')) > 1:
             path = path.split('.jpg')[0]
         img = ImageDB.Image(path, img, label, poly, keypoints)
+        img.set_id(max([i.id for i in self.images], default=0) + 1)
         self.images.append(img)
 
         if processed_img is not None:
@@ -101,6 +365,125 @@ class ImageDB:
         with open(path + '.pickle', 'wb') as f:
             pickle.dump(img, f)
 
+        # new image has no features yet
+        self.features_key = None
+        for listener in self.listeners:
+            listener(img)
+
+
+def is_binary_descriptor(descriptor):
+    '''Binary descriptors (AKAZE, BRISK, ORB) are compared with the Hamming distance'''
+    return descriptor.defaultNorm() in (cv2.NORM_HAMMING, cv2.NORM_HAMMING2)
+
+def create_matcher(descriptor, brute_force=False):
+    '''Create a matcher suited to the descriptor: LSH (or brute force Hamming) for binary descriptors
+       and a KD-tree for float descriptors. Returns the matcher and the dtype it expects'''
+    if is_binary_descriptor(descriptor):
+        if brute_force:
+            return cv2.BFMatcher(descriptor.defaultNorm()), np.uint8
+        FLANN_INDEX_LSH = 6
+        index_params = dict(algorithm = FLANN_INDEX_LSH, table_number = 6, key_size = 12, multi_probe_level = 1)
+        dtype = np.uint8
+    else:
+        if brute_force:
+            return cv2.BFMatcher(descriptor.defaultNorm()), np.float32
+        FLANN_INDEX_KDTREE = 0
+        index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+        dtype = np.float32
+    search_params = dict(checks=50)
+    return cv2.FlannBasedMatcher(index_params, search_params), dtype
+
+
+def color_signature(img, poly=None, bins=(16, 8)):
+    '''Hue-saturation histogram of img (normalized to sum to 1), limited to poly if given.
+       Cheap to compare, so it is used to rank templates before descriptor matching'''
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    mask = None
+    if poly is not None:
+        mask = np.zeros(img.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [np.int32(poly).reshape(-1,1,2)], 255)
+        if cv2.countNonZero(mask) == 0:
+            mask = None
+    hist = cv2.calcHist([hsv], [0, 1], mask, list(bins), [0, 180, 0, 256]).ravel()
+    return hist / max(hist.sum(), 1)
+
+class TemplateIndex:
+    '''A single descriptor index over all templates. Matching a segment is one query
+       and the rows of the index map back to the template they came from'''
+    def __init__(self, descriptor, max_neighbors=8, brute_force=False):
+        self.matcher, self.dtype = create_matcher(descriptor, brute_force)
+        self.max_neighbors = max_neighbors
+        self.templates = []
+        self.keypoints = []
+        self.features = []
+        # each template's color signature, or None to always be a candidate
+        self.signatures = []
+        self._sqrt_signatures = []
+        self._trained = False
+
+    def __len__(self):
+        return len(self.templates)
+
+    def add(self, template, keypoints, features, signature=None):
+        '''Add a template. The index is retrained on the next match'''
+        if features is None or len(features) < 2:
+            return False
+        self.templates.append(template)
+        self.keypoints.append(keypoints)
+        # convert once here, rather than on every match
+        features = np.asarray(features, dtype=self.dtype)
+        self.features.append(features)
+        self.signatures.append(signature)
+        self._sqrt_signatures.append(None if signature is None else np.sqrt(signature))
+        self.matcher.add([features])
+        self._trained = False
+        return True
+
+    def candidates(self, signature, top_k):
+        '''Indices of the top_k templates whose color signature is closest (Hellinger distance)
+           to signature, plus any templates without a signature. None if that is all of them'''
+        if len(self.templates) <= top_k:
+            return None
+        q = np.sqrt(signature)
+        similarity = np.array([2 if s is None else np.dot(s, q) for s in self._sqrt_signatures])
+        return sorted(np.argsort(-similarity)[:top_k])
+
+    def train(self):
+        '''Train the matcher now rather than on the first match'''
+        if not self._trained and len(self.templates) > 0:
+            self.matcher.train()
+            self._trained = True
+
+    def match(self, des, ratio, candidates=None):
+        '''Match segment descriptors against every template, or only the template indices in candidates.
+           Candidates are looked up in the same index and only their neighbors are kept, which saves
+           verifying the other templates.
+           Returns a dict of template index to the matches which pass the ratio test for that template.
+           m.queryIdx is the segment keypoint and m.trainIdx the template keypoint'''
+        if len(self.templates) == 0 or des is None or len(des) == 0:
+            return {}
+        des = np.asarray(des, dtype=self.dtype)
+        self.train()
+        k = max(2, min(2 * len(self.templates), self.max_neighbors))
+        knn = self.matcher.knnMatch(des, k=k)
+        keep = None if candidates is None else set(candidates)
+        votes = {}
+        for neighbors in knn:
+            if len(neighbors) < 2:
+                continue
+            # do the ratio test within each template. If a template only has one of the
+            # neighbors, its second best is at least as far as the furthest neighbor
+            bound = neighbors[-1].distance
+            by_template = {}
+            for m in neighbors:
+                if keep is None or m.imgIdx in keep:
+                    by_template.setdefault(m.imgIdx, []).append(m)
+            for i, ms in by_template.items():
+                second = ms[1].distance if len(ms) > 1 else bound
+                if ms[0].distance < ratio * second:
+                    votes.setdefault(i, []).append(ms[0])
+        return votes
+
 
 def stretch_rectangle(rect, frame, stretch=1.2):
     # stretch out the rectangle
@@ -122,17 +505,113 @@ def rect_view(frame, rect):
         raise ValueError('Attempting to create too small of a view')
     return frame[ rect[1]:(rect[1] + rect[3]), rect[0]:(rect[0] + rect[2]) ]
 
-def keypoints_view(desc, frame, rect):
-    '''return the keypoints limited to a region'''
+def keypoints_view(desc, frame, rect, max_size=None):
+    '''return the keypoints limited to a region. The region is shrunk to max_size first if given'''
     rect = stretch_rectangle(rect, frame)#embiggen the rectangle by 1.2x
 
     frame_view = rect_view(frame, rect)#restrict area of interest to the embiggened rectangle
-    kp, des = desc.detectAndCompute(frame_view,None)#get the keypoints in that region
+    kp, des = detect_and_compute(desc, frame_view, max_size)#get the keypoints in that region
     #need to transform the key points back
     for i in range(len(kp)):
         kp[i].pt = (rect[0] + kp[i].pt[0], rect[1] + kp[i].pt[1])
     return kp, des
 
+class KeypointCache:
+    '''Keypoints and descriptors of regions of recent frames, so that identification
+       and decoration of the same segment only extract them once'''
+    def __init__(self, max_frames=2):
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+
+    def get(self, desc, frame, rect, frame_ind=None, max_size=None):
+        '''Same as keypoints_view, but cached by frame_ind, stretched rect and descriptor configuration'''
+        if frame_ind is None:
+            return keypoints_view(desc, frame, rect, max_size)
+        key = (stretch_rectangle(rect, frame), features_key(desc, max_size))
+        entries = self._entries(frame_ind)
+        if key not in entries:
+            entries[key] = keypoints_view(desc, frame, rect, max_size)
+        return entries[key]
+
+    def put(self, desc, frame, rect, frame_ind, value, max_size=None):
+        '''Store keypoints and descriptors which are known for a region from elsewhere'''
+        self._entries(frame_ind)[(stretch_rectangle(rect, frame), features_key(desc, max_size))] = value
+
+    def _entries(self, frame_ind):
+        entries = self.frames.get(frame_ind)
+        if entries is None:
+            entries = self.frames[frame_ind] = {}
+            # drop the frames seen longest ago. Not by index, which restarts when a video loops
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return entries
+
+    def clear(self):
+        self.frames = OrderedDict()
+
+class SegmentCache:
+    '''Remembers a value for each segment and gives it back while the pixels of the segment
+       are unchanged. A segment is fingerprinted by a small grayscale thumbnail of its
+       stretched rectangle, which is cheap compared to extracting keypoints'''
+    def __init__(self, threshold=6, size=16, max_shift=4, max_age=30):
+        self.threshold = threshold # mean absolute difference of thumbnails, in gray levels
+        self.size = size
+        self.max_shift = max_shift # how far segmentation can move a rect and it still be the same segment
+        self.max_age = max_age # recompute after this many reuses anyway
+        self.entries = []
+        self._next = []
+
+    def fingerprint(self, frame, rect):
+        view = rect_view(frame, stretch_rectangle(rect, frame))
+        if len(view.shape) == 3:
+            view = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(view, (self.size, self.size), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def begin(self):
+        '''Start a new frame. Segments not seen between begin and end are forgotten'''
+        self._next = []
+
+    def end(self):
+        self.entries = self._next
+        self._next = []
+
+    def get(self, frame, rect, tag=None):
+        '''Returns (fingerprint, value). value is None if the segment changed or is new.
+           tag must be the same object as when stored, so results are dropped when
+           whatever produced them (e.g. a template index) is replaced'''
+        fingerprint = self.fingerprint(frame, rect)
+        for i, (r, f, t, age, value) in enumerate(self.entries):
+            if t is not tag or age >= self.max_age:
+                continue
+            if max(abs(a - b) for a,b in zip(r, rect)) > self.max_shift:
+                continue
+            if np.mean(np.abs(f - fingerprint)) < self.threshold:
+                # keep the old fingerprint, so slow drift still triggers a recompute
+                self._next.append((rect, f, t, age + 1, value))
+                del self.entries[i]
+                return fingerprint, value
+        return fingerprint, None
+
+    def put(self, rect, fingerprint, value, tag=None):
+        self._next.append((rect, fingerprint, tag, 0, value))
+
+def label_pixels(labels, first=1, last=None):
+    '''Group the (row, col) coordinates of a label image by label in a single pass.
+       Returns (label, pixels) for each non-empty label in [first, last), in label order.
+       pixels are in the same order np.argwhere(labels == label) would give'''
+    if last is None:
+        last = np.max(labels) + 1
+    flat = labels.ravel()
+    index = np.flatnonzero((flat >= first) & (flat < last))
+    if len(index) == 0:
+        return []
+    # stable sort keeps pixels of one label in row-major order
+    index = index[np.argsort(flat[index], kind='stable')]
+    sorted_labels = flat[index]
+    splits = np.flatnonzero(np.diff(sorted_labels)) + 1
+    pixels = np.stack(np.divmod(index, labels.shape[1]), axis=1)
+    return list(zip(sorted_labels[np.concatenate(([0], splits))], np.split(pixels, splits)))
+
 def draw_rectangle(frame, rect, *args):
     rect = [int(r) for r in rect]
     cv2.rectangle(frame, (rect[0], rect[1]), (rect[0] + rect[2], rect[1] + rect[3]), *args)
@@ -145,6 +624,15 @@ def intersecting_rects(a, b):
         return True
     return False
 
+def rect_iou(a, b):
+    '''Intersection over union of two (x, y, w, h) rectangles'''
+    dx = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    dy = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if dx <= 0 or dy <= 0:
+        return 0.
+    inter = dx * dy
+    return inter / (a[2] * a[3] + b[2] * b[3] - inter)
+
 def scale_point(point, frame):
     '''Takes in a point as a tuple of ints and returns a list of floats in scaled coordinates (0 to 1)'''
     x = float(point[0])/frame.shape[1]
@@ -233,16 +721,452 @@ def distance_pts(endpoints):
 def val_in_range(val, lower_bound,upper_bound):
     return ((val >= lower_bound) and (val <= upper_bound))
 
-def load_darkflow(directory, threshold=0.2, **args):
+def line_angles(point, points):
+    '''Angles (pi/2 + arctan(slope)) of the lines from point to each row of points.
+       Vectorized version of line_from_endpoints, using the same slope conventions'''
+    point = np.asarray(point, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    # line_from_endpoints is always given the endpoint with the larger y first
+    point_first = (point[1] > points[:,1])[:,np.newaxis]
+    endpoint1 = np.where(point_first, point, points)
+    endpoint2 = np.where(point_first, points, point)
+    dx = endpoint1[:,0] - endpoint2[:,0]
+    dy = np.abs(endpoint1[:,1] - endpoint2[:,1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(dx == 0, np.inf, np.sign(dx) * dy / np.abs(dx))
+    return np.pi/2.0 + np.arctan(slope)
+
+class SpatialHash:
+    '''Uniform grid of points so neighbors within a radius can be found without checking every point'''
+    def __init__(self, cell_size):
+        self.cell_size = max(1.0, float(cell_size))
+        self._cells = {}
+
+    def _cell(self, point):
+        return (int(math.floor(point[0] / self.cell_size)), int(math.floor(point[1] / self.cell_size)))
+
+    def insert(self, key, point):
+        self._cells.setdefault(self._cell(point), []).append(key)
+
+    def query(self, point, radius):
+        '''Returns the sorted keys of points which may be within radius of point. Callers still need to check the exact distance'''
+        reach = int(math.ceil(radius / self.cell_size))
+        cx, cy = self._cell(point)
+        keys = set()
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                keys.update(self._cells.get((i,j), []))
+        return sorted(keys)
+
+class ConstantVelocityFilter:
+    '''Kalman filter for a 2D point moving with nearly constant velocity. Time is counted in ticks'''
+    def __init__(self, point, process_noise=1e-5, measurement_noise=1e-4):
+        self.state = np.array([point[0], point[1], 0.0, 0.0], dtype=np.float64)
+        self.covariance = np.diag([measurement_noise, measurement_noise, 10 * measurement_noise, 10 * measurement_noise])
+        self.transition = np.array([[1., 0., 1., 0.],
+                                    [0., 1., 0., 1.],
+                                    [0., 0., 1., 0.],
+                                    [0., 0., 0., 1.]])
+        self.measurement = np.array([[1., 0., 0., 0.],
+                                     [0., 1., 0., 0.]])
+        # white noise acceleration
+        self.process_noise = process_noise * np.array([[0.25, 0., 0.5, 0.],
+                                                       [0., 0.25, 0., 0.5],
+                                                       [0.5, 0., 1., 0.],
+                                                       [0., 0.5, 0., 1.]])
+        self.measurement_noise = measurement_noise * np.identity(2)
+
+    @property
+    def position(self):
+        return self.state[:2]
+
+    @property
+    def velocity(self):
+        return self.state[2:]
+
+    def predict(self, steps=1):
+        for i in range(steps):
+            self.state = self.transition @ self.state
+            self.covariance = self.transition @ self.covariance @ self.transition.T + self.process_noise
+        return self.position
+
+    def _innovation(self, point, measurement_noise=None):
+        R = self.measurement_noise if measurement_noise is None else measurement_noise * np.identity(2)
+        residual = np.asarray(point, dtype=np.float64) - self.measurement @ self.state
+        S = self.measurement @ self.covariance @ self.measurement.T + R
+        return residual, S
+
+    def mahalanobis(self, point):
+        '''Squared Mahalanobis distance of a measurement from the predicted position'''
+        residual, S = self._innovation(point)
+        return float(residual @ np.linalg.solve(S, residual))
+
+    def correct(self, point, measurement_noise=None):
+        residual, S = self._innovation(point, measurement_noise)
+        gain = self.covariance @ self.measurement.T @ np.linalg.inv(S)
+        self.state = self.state + gain @ residual
+        self.covariance = (np.identity(4) - gain @ self.measurement) @ self.covariance
+        return self.position
+
+    def extrapolate(self, point, steps):
+        '''Where a point measured steps ago would be now, moving at the current velocity'''
+        return np.asarray(point, dtype=np.float64) + self.velocity * steps
+
+def _network_size(input_size):
+    '''(width, height) from a size or a (width, height), in multiples of 32'''
+    # the tiny-YOLO networks are fully convolutional and downsample by 32, so any multiple works
+    if not isinstance(input_size, (tuple, list)):
+        input_size = (input_size, input_size)
+    return tuple(max(32, int(round(s / 32)) * 32) for s in input_size)
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+class OpenCVDarkflow:
+    '''Runs a darkflow-exported tiny-YOLO graph on the CPU with OpenCV's DNN module, without tensorflow.
+       return_predict gives the same boxes as TFNet.return_predict. input_size overrides the square
+       network input from the meta (rounded to a multiple of 32) and threads sets OpenCV's thread count'''
+    # predict_batch honours input_size
+    resizable_input = True
+
+    def __init__(self, pb, meta, threshold=0.2, input_size=None, threads=None, nms_threshold=0.4):
+        with open(meta) as f:
+            self.meta = json.load(f)
+        self.labels = self.meta['labels']
+        self.anchors = np.array(self.meta['anchors'], dtype=np.float32).reshape(-1, 2)
+        if input_size is None:
+            self.input_size = tuple(self.meta['inp_size'][1::-1])
+        else:
+            self.input_size = _network_size(input_size)
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        if threads is not None:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromTensorflow(pb)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def return_predict(self, img):
+        return self.predict_batch([img])[0]
+
+    def predict_batch(self, imgs, input_size=None):
+        '''return_predict for each image, with a single forward pass. input_size, a size or (width, height),
+           overrides the network input'''
+        size = self.input_size if input_size is None else _network_size(input_size)
+        # darkflow feeds RGB scaled to [0, 1]
+        blob = cv2.dnn.blobFromImages(imgs, 1 / 255, size, swapRB=True, crop=False)
+        self.net.setInput(blob)
+        out = self.net.forward()
+        return [self.region_boxes(out[i:i + 1], img.shape[1], img.shape[0]) for i, img in enumerate(imgs)]
+
+    def region_boxes(self, out, width, height):
+        '''Decode the YOLOv2 region output into darkflow-style boxes on an image of width x height'''
+        n_anchors, n_classes = len(self.anchors), len(self.labels)
+        out = out[0]
+        # OpenCV gives channels first, tensorflow channels last
+        if out.shape[0] == n_anchors * (5 + n_classes):
+            out = out.transpose(1, 2, 0)
+        rows, cols = out.shape[:2]
+        out = out.reshape(rows, cols, n_anchors, 5 + n_classes)
+        col, row = np.meshgrid(np.arange(cols), np.arange(rows))
+        x = (col[..., None] + _sigmoid(out[..., 0])) / cols
+        y = (row[..., None] + _sigmoid(out[..., 1])) / rows
+        w = np.exp(out[..., 2]) * self.anchors[:, 0] / cols
+        h = np.exp(out[..., 3]) * self.anchors[:, 1] / rows
+        scores = np.exp(out[..., 5:] - out[..., 5:].max(axis=-1, keepdims=True))
+        probs = scores / scores.sum(axis=-1, keepdims=True) * _sigmoid(out[..., 4])[..., None]
+        boxes = np.stack((x, y, w, h), axis=-1).reshape(-1, 4)
+        probs = probs.reshape(-1, n_classes)
+        probs[probs <= self.threshold] = 0
+        # suppression is per class and before choosing a label, like darkflow
+        for c in range(n_classes):
+            candidates = np.flatnonzero(probs[:, c])
+            probs[candidates[~_keep_boxes(boxes[candidates], probs[candidates, c], self.nms_threshold)], c] = 0
+        classes = probs.argmax(axis=-1)
+        confidence = probs.max(axis=-1)
+        result = []
+        for i in np.argsort(-confidence):
+            if confidence[i] <= self.threshold:
+                break
+            x, y, w, h = boxes[i]
+            result.append({'label': self.labels[classes[i]], 'confidence': float(confidence[i]),
+                           'topleft': {'x': max(0, int((x - w / 2) * width)), 'y': max(0, int((y - h / 2) * height))},
+                           'bottomright': {'x': min(width - 1, int((x + w / 2) * width)),
+                                           'y': min(height - 1, int((y + h / 2) * height))}})
+        return result
+
+def _keep_boxes(boxes, scores, threshold):
+    '''Greedy non-maximum suppression of (center x, center y, w, h) boxes. Returns a mask of those kept'''
+    keep = np.ones(len(boxes), dtype=bool)
+    order = np.argsort(-scores, kind='stable')
+    lo, hi = boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2
+    area = boxes[:, 2] * boxes[:, 3]
+    for n, i in enumerate(order):
+        if not keep[i]:
+            continue
+        rest = order[n + 1:][keep[order[n + 1:]]]
+        overlap = np.clip(np.minimum(hi[rest], hi[i]) - np.maximum(lo[rest], lo[i]), 0, None).prod(axis=1)
+        keep[rest[overlap / (area[rest] + area[i] - overlap) >= threshold]] = False
+    return keep
+
+class TFNetDarkflow:
+    '''darkflow's TFNet, with predict_batch added'''
+    # the graph's input size is fixed, images are stretched to it
+    resizable_input = False
+
+    def __init__(self, pb, meta, threshold=0.2, gpu=1.0, **args):
+        # importing darkflow brings in tensorflow, which is slow, so only do it when a model is loaded
+        from darkflow.net.build import TFNet
+        options = args
+        options.update(pbLoad=pb, metaLoad=meta, threshold=threshold, gpu=gpu)
+        self.tfnet = TFNet(options)
+
+    def return_predict(self, img):
+        return self.tfnet.return_predict(img)
+
+    def predict_batch(self, imgs, input_size=None):
+        '''return_predict for each image, with a single forward pass. The graph's input size is fixed,
+           so input_size is ignored. A single image goes through return_predict itself, since batches need
+           darkflow's internals'''
+        if len(imgs) == 1:
+            return [self.tfnet.return_predict(imgs[0])]
+        net = self.tfnet
+        batch = np.stack([net.framework.resize_input(img) for img in imgs])
+        out = net.sess.run(net.out, {net.inp: batch})
+        results = []
+        for img, o in zip(imgs, out):
+            boxes = [net.framework.process_box(b, img.shape[0], img.shape[1], net.FLAGS.threshold) for b in net.framework.findboxes(o)]
+            results.append([{'label': b[4], 'confidence': b[6], 'topleft': {'x': b[0], 'y': b[2]},
+                             'bottomright': {'x': b[1], 'y': b[3]}} for b in boxes if b is not None])
+        return results
+
+# the detector backends. Each is built from the pb and meta paths and a threshold and has return_predict(img)
+# and predict_batch(imgs, input_size=None), giving lists of dicts with topleft, bottomright, label and confidence.
+# resizable_input says whether predict_batch can take input_size rather than stretching images to the model's size
+DETECTOR_BACKENDS = {'tensorflow': TFNetDarkflow,
+                     'opencv': OpenCVDarkflow}
+
+def darkflow_input_size(directory, input_size=None):
+    '''The (width, height) a darkflow model takes its input at, optionally overridden like OpenCVDarkflow does'''
+    if input_size is not None:
+        return _network_size(input_size)
+    resource_path =pkg_resources.resource_filename(__name__, 'resources/models/' + directory)
+    with open(glob.glob(resource_path + '/*.meta')[0]) as f:
+        return tuple(json.load(f)['inp_size'][1::-1])
+
+def load_darkflow(directory, threshold=0.2, backend='tensorflow', **args):
     resource_path =pkg_resources.resource_filename(__name__, 'resources/models/' + directory)
-    options = args
-    options['threshold'] = threshold
     try:
-        options['pbLoad'] = list(glob.glob(resource_path + '/*.pb'))[0]
-        options['metaLoad'] = list(glob.glob(resource_path + '/*.meta'))[0]
+        pb = list(glob.glob(resource_path + '/*.pb'))[0]
+        meta = list(glob.glob(resource_path + '/*.meta'))[0]
     except IndexError:
         raise FileNotFoundError(f'Could not find darkflow model pb or meta in {resource_path}')
-    return TFNet(options)
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError('Unknown detector backend {}, choose from {}'.format(backend, list(DETECTOR_BACKENDS)))
+    return DETECTOR_BACKENDS[backend](pb, meta, threshold, **args)
+
+def benchmark_darkflow(directory, frames, backends=None, threshold=0.2, repeats=1, options=None, batch=1):
+    '''Time the detector backends on the same frames, batch frames per forward pass. Times are per frame.
+       options maps a backend to its extra arguments.
+       Boxes are compared to the first backend that loads: agreement is the fraction of its boxes found
+       by the other with the same label and an IoU over 0.5. Returns a dict of stats per backend'''
+    backends = list(DETECTOR_BACKENDS) if backends is None else backends
+    options = {} if options is None else options
+    stats, reference = {}, None
+    for backend in backends:
+        start = time.time()
+        try:
+            net = load_darkflow(directory, threshold, backend, **options.get(backend, {}))
+        except Exception as e:
+            print('Could not load {} backend: {}'.format(backend, e))
+            continue
+        load_s = time.time() - start
+        net.predict_batch(frames[:batch])
+        times, results = [], []
+        for _ in range(repeats):
+            for i in range(0, len(frames), batch):
+                start = time.time()
+                results.extend(net.predict_batch(frames[i:i + batch]))
+                times.append((time.time() - start) * 1000 / len(frames[i:i + batch]))
+        results = results[:len(frames)]
+        stats[backend] = {'load_s': load_s, 'mean_ms': float(np.mean(times)),
+                          'p95_ms': float(np.percentile(times, 95)),
+                          'boxes': sum(len(r) for r in results)}
+        if reference is None:
+            reference = results
+        else:
+            found = [any(b['label'] == a['label'] and rect_iou(darkflow_to_rect(a), darkflow_to_rect(b)) > 0.5 for b in r2)
+                     for r1, r2 in zip(reference, results) for a in r1]
+            stats[backend]['agreement'] = float(np.mean(found)) if found else 1.0
+        print('{}: {}'.format(backend, ', '.join('{} {:.3g}'.format(k, v) for k, v in stats[backend].items())))
+    return stats
+
+def _darkflow_worker(conn, directory, options):
+    '''Main loop of the DarkflowWorker process'''
+    try:
+        net = load_darkflow(directory, **options)
+    except Exception as e:
+        conn.send(('error', repr(e)))
+        return
+    buffers = {}
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        name, items, input_size = msg
+        if name not in buffers:
+            [b.close() for b in buffers.values()]
+            buffers = {name: shared_memory.SharedMemory(name=name)}
+        imgs = [np.ndarray(shape, dtype=dtype, buffer=buffers[name].buf, offset=offset) for offset, shape, dtype, _ in items]
+        try:
+            results = net.predict_batch(imgs, input_size)
+        except Exception as e:
+            print('darkflow inference failed: {}'.format(e))
+            results = [[] for _ in imgs]
+        del imgs
+        conn.send([(key, result) for (_, _, _, key), result in zip(items, results)])
+    [b.close() for b in buffers.values()]
+
+class DarkflowWorker:
+    '''Runs a darkflow model in its own process, so inference does not block the event loop.
+       Images are passed through shared memory and several go through the network together as a batch.
+       submit never waits: if the worker is busy the frame is queued, keeping only the newest max_batch,
+       and those are sent as one batch when it is free. With max_batch=1 frames arriving while busy are dropped.
+       latest gives the newest finished result with the key (frame_ind) it came from and take gives
+       every result finished since the last take, in order.
+       The process, and so the model, is only started by the first submit or by calling start'''
+    # finished results kept for take, for when nobody is taking them
+    KEEP_FINISHED = 64
+
+    def __init__(self, directory, max_batch=1, **options):
+        self.directory = directory
+        self.options = options
+        self.max_batch = max_batch
+        self.process = None
+        self._conn = None
+        self._shm = None
+        self._pending = []
+        self._finished = []
+        self.busy = False
+        self.error = None
+        self.result_ind = None
+        self.result = []
+
+    def start(self):
+        '''Start loading the model in the background, if that has not happened yet'''
+        if self.process is not None:
+            return
+        # tensorflow does not survive a fork, so start a fresh interpreter
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_darkflow_worker, args=(child_conn, self.directory, self.options), daemon=True)
+        self.process.start()
+        # only the worker holds its end, so the pipe closes if it dies
+        child_conn.close()
+
+    def submit(self, frame, frame_ind):
+        '''Run inference on frame, now if the worker is free or otherwise with the next batch.
+           Returns True if it was sent now'''
+        self.start()
+        self.poll()
+        if self.error is not None:
+            return False
+        if self.busy:
+            if self.max_batch > 1:
+                self._pending = self._pending[-(self.max_batch - 1):] + [(frame, frame_ind)]
+            return False
+        return self._send([(frame, frame_ind)])
+
+    def submit_batch(self, inputs, input_size=None):
+        '''Run inference on a list of (image, key) in one forward pass, if the worker is free.
+           The images may differ in size, such as crops of one frame. input_size overrides the network
+           input, where the backend allows it. Returns True if they were sent'''
+        self.start()
+        self.poll()
+        if self.busy or self.error is not None or len(inputs) == 0:
+            return False
+        return self._send(inputs, input_size)
+
+    def _send(self, inputs, input_size=None):
+        size = sum(img.nbytes for img, _ in inputs)
+        if self._shm is None or self._shm.size < size:
+            self._release()
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        items, offset = [], 0
+        for img, key in inputs:
+            np.ndarray(img.shape, dtype=img.dtype, buffer=self._shm.buf, offset=offset)[:] = img
+            items.append((offset, img.shape, img.dtype.str, key))
+            offset += img.nbytes
+        try:
+            self._conn.send((self._shm.name, items, input_size))
+        except (BrokenPipeError, OSError) as e:
+            self._stopped(e)
+            return False
+        self.busy = True
+        return True
+
+    def _stopped(self, e):
+        '''The worker process is gone, so stop submitting to it'''
+        self.error = repr(e)
+        self.busy = False
+        self._pending = []
+        print('darkflow worker stopped: {}'.format(self.error))
+
+    def poll(self):
+        '''Collect any finished results and send what is queued. Returns True if there were results'''
+        got = False
+        while self.process is not None and self.error is None:
+            try:
+                if not self._conn.poll():
+                    # results sent before it died can still be read, so only check once there are none
+                    if not self.process.is_alive():
+                        raise EOFError('worker exited with code {}'.format(self.process.exitcode))
+                    break
+                msg = self._conn.recv()
+            except (EOFError, OSError) as e:
+                self._stopped(e)
+                break
+            if msg[0] == 'error':
+                self.error = msg[1]
+                print('darkflow worker failed to start: {}'.format(self.error))
+                break
+            self._finished = (self._finished + msg)[-self.KEEP_FINISHED:]
+            self.result_ind, self.result = msg[-1]
+            self.busy = False
+            got = True
+        if not self.busy and self._pending and self.error is None:
+            pending, self._pending = self._pending, []
+            self._send(pending)
+        return got
+
+    def latest(self):
+        '''The newest result and the frame_ind it was computed on (None if there is none yet)'''
+        self.poll()
+        return self.result_ind, self.result
+
+    def take(self):
+        '''All (key, result) finished since the last take, in the order they were submitted'''
+        self.poll()
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self._conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._release()
 
 def darkflow_to_box(df):
     #opencv-style bboxes are [x1, y1, x2, y2] but it's top-down for y, and frame.shape[0] is y-shape
@@ -253,9 +1177,9 @@ def darkflow_to_rect(df):
     rect = [ df['topleft']['x'], df['topleft']['y'], df['bottomright']['x'] - df['topleft']['x'], df['bottomright']['y'] - df['topleft']['y'] ]
     return rect
 
-def diff_blur(frame1, frame2, grayscale=True):
+def diff_blur(frame1, frame2, grayscale=True, ksize=7):
     img = cv2.absdiff(frame1, frame2)
     if grayscale:
         img = np.sum(img, 2).astype(np.uint8)
-    img = cv2.medianBlur(img, 7)
+    img = cv2.medianBlur(img, ksize)
     return img
\ No newline at end of file
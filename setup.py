@@ -39,7 +39,8 @@ setup(
     author_email='white.d.andrew@gmail.com',
     entry_points=
        {
-           'console_scripts': ['arcvision=arcvision.controller:main'],
+           'console_scripts': ['arcvision=arcvision.controller:main',
+                               'arcvision-benchmark-detector=arcvision.controller:benchmark_detector'],
         }
 
 )
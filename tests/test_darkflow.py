@@ -0,0 +1,156 @@
+import multiprocessing
+import subprocess
+import sys
+import numpy as np
+from arcvision import utils
+from arcvision.utils import OpenCVDarkflow, TFNetDarkflow, DarkflowWorker
+from arcvision.processor import DarkflowDetectionProcessor, DarkflowSegmentProcessor
+
+
+class FakeCamera:
+    def add_frame_processor(self, p):
+        pass
+
+    def remove_frame_processor(self, p):
+        pass
+
+
+def silent_worker(conn, *args):
+    '''Stands in for a worker process which holds its end of the pipe but never answers, until it is closed'''
+    try:
+        while conn.recv() is not None:
+            pass
+    except EOFError:
+        pass
+
+
+def test_worker_death_stops_submission():
+    worker = DarkflowWorker('dot-tracking')
+    # started the way start does
+    ctx = multiprocessing.get_context('spawn')
+    worker._conn, child_conn = ctx.Pipe()
+    worker.process = ctx.Process(target=silent_worker, args=(child_conn,), daemon=True)
+    worker.process.start()
+    child_conn.close()
+    frame = np.zeros((32, 32, 3), dtype=np.uint8)
+    try:
+        assert worker.submit(frame, 1)
+        assert worker.busy and worker.error is None
+        worker.process.kill()
+        worker.process.join()
+        assert not worker.poll()
+        assert worker.error is not None and not worker.busy
+        assert not worker.submit(frame, 2)
+        assert worker.latest() == (None, [])
+    finally:
+        worker.close()
+
+
+def test_darkflow_is_loaded_lazily(monkeypatch):
+    # importing arcvision does not bring in darkflow or tensorflow
+    check = "import sys, arcvision.processor; assert not {'darkflow', 'tensorflow'} & set(sys.modules)"
+    subprocess.run([sys.executable, '-c', check], check=True)
+    monkeypatch.setattr(utils, '_darkflow_worker', silent_worker)
+    background = np.zeros((720, 1280, 3), dtype=np.uint8)
+    segmenter = DarkflowSegmentProcessor(FakeCamera())
+    detector = DarkflowDetectionProcessor(FakeCamera(), background)
+    try:
+        # constructing the processors starts no process, warming or the first submit does
+        assert segmenter.worker.process is None and detector.worker.process is None
+        segmenter.warm()
+        process = segmenter.worker.process
+        assert process.is_alive()
+        segmenter.warm()
+        assert segmenter.worker.process is process
+        assert detector.worker.submit(background, 1)
+        assert detector.worker.process.is_alive()
+    finally:
+        segmenter.close()
+        detector.close()
+
+
+def test_roi_needs_a_resizable_backend():
+    background = np.zeros((720, 1280, 3), dtype=np.uint8)
+    processor = DarkflowDetectionProcessor(FakeCamera(), background, roi=True, backend='tensorflow')
+    assert not processor.roi
+    processor.roi = True
+    assert not processor.roi
+    processor = DarkflowDetectionProcessor(FakeCamera(), background, roi=True, backend='opencv')
+    assert processor.roi
+    processor.roi = False
+    assert not processor.roi
+    # crops are placed around tracked objects
+    assert not DarkflowDetectionProcessor(FakeCamera(), background, roi=True, track=False, backend='opencv').roi
+
+
+class FakeTFNet:
+    '''Only has darkflow's public return_predict'''
+    def return_predict(self, img):
+        return [{'label': 'reactor', 'confidence': 0.5, 'topleft': {'x': 0, 'y': 0},
+                 'bottomright': {'x': img.shape[1] - 1, 'y': img.shape[0] - 1}}]
+
+
+def test_tensorflow_single_image_uses_return_predict():
+    df = TFNetDarkflow.__new__(TFNetDarkflow)
+    df.tfnet = FakeTFNet()
+    img = np.zeros((20, 30, 3), dtype=np.uint8)
+    assert df.predict_batch([img]) == [df.tfnet.return_predict(img)]
+
+
+def region_decoder(anchors, labels, threshold=0.3, nms_threshold=0.4):
+    '''OpenCVDarkflow without a network, for decoding'''
+    df = OpenCVDarkflow.__new__(OpenCVDarkflow)
+    df.anchors = np.array(anchors, dtype=np.float32).reshape(-1, 2)
+    df.labels = labels
+    df.threshold = threshold
+    df.nms_threshold = nms_threshold
+    return df
+
+
+def test_region_boxes():
+    df = region_decoder([[1, 1], [2, 2]], ['a', 'b'])
+    # 2 x 2 cells, channels first as OpenCV gives them, every box unlikely
+    out = np.zeros((1, 2, 7, 2, 2), dtype=np.float32)
+    out[:, :, 4] = -20
+    # a box of class a centered in row 1, column 0, the size of the first anchor
+    out[0, 0, 4, 1, 0] = 20
+    out[0, 0, 5, 1, 0] = 5
+    # the second anchor with the same box, but less certain, is suppressed
+    out[0, 1, 2:4, 1, 0] = np.log(0.5)
+    out[0, 1, 4, 1, 0] = 1
+    out[0, 1, 5, 1, 0] = 5
+    # a box of class b in row 0, column 1
+    out[0, 1, 4, 0, 1] = 2
+    out[0, 1, 6, 0, 1] = 5
+    result = df.region_boxes(out.reshape(1, 14, 2, 2), 100, 200)
+    assert [r['label'] for r in result] == ['a', 'b']
+    assert result[0]['confidence'] > result[1]['confidence'] > 0.3
+    assert result[0]['topleft'] == {'x': 0, 'y': 100}
+    # clipped to the image
+    assert result[0]['bottomright'] == {'x': 50, 'y': 199}
+    assert result[1]['topleft'] == {'x': 25, 'y': 0}
+    assert result[1]['bottomright'] == {'x': 99, 'y': 150}
+    # tensorflow gives channels last
+    tf_out = out.reshape(1, 14, 2, 2).transpose(0, 2, 3, 1)
+    assert df.region_boxes(tf_out, 100, 200) == result
+
+
+def test_from_mosaic():
+    processor = DarkflowDetectionProcessor.__new__(DarkflowDetectionProcessor)
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+    frame[100:164, 200:264] = 1
+    frame[0:64, 0:64] = 2
+    crops = [(200, 100, 64, 64), (0, 0, 64, 64)]
+    mosaic, tiles, size = processor._mosaic(frame, crops, 32)
+    assert mosaic.shape == (64, 128, 3) and size == (64, 32)
+    assert np.all(mosaic[:, :64] == 1) and np.all(mosaic[:, 64:] == 2)
+    # inside the first tile, moved back to the frame
+    assert processor._from_mosaic((10, 20, 30, 30), tiles, frame) == (210, 120, 30, 30)
+    # touching a tile edge which is inside the frame, so likely cut off
+    assert processor._from_mosaic((1, 20, 30, 30), tiles, frame) is None
+    assert processor._from_mosaic((10, 20, 30, 44), tiles, frame) is None
+    # the second tile is in the corner of the frame, where touching its top or left edge is fine
+    assert processor._from_mosaic((64, 0, 20, 20), tiles, frame) == (0, 0, 20, 20)
+    assert processor._from_mosaic((100, 10, 27, 20), tiles, frame) is None
+    # centered outside every tile
+    assert processor._from_mosaic((120, 40, 40, 40), tiles, frame) is None
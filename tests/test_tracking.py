@@ -0,0 +1,431 @@
+import asyncio
+import copy
+import types
+import cv2
+import numpy as np
+import pytest
+from arcvision.utils import ConstantVelocityFilter, ImageDB, TemplateIndex, distance_pts, line_from_endpoints, \
+    val_in_range, descriptor_config, features_key, pack_keypoints
+from arcvision import processor
+
+
+class FakeCamera:
+    def add_frame_processor(self, p):
+        pass
+
+    def remove_frame_processor(self, p):
+        pass
+
+
+class ConstantFlow:
+    '''Stands in for the dense optical flow, moving everything by dx pixels'''
+    def __init__(self, dx):
+        self.dx = dx
+
+    def calc(self, img0, img1, flow):
+        p1 = np.zeros(img0.shape + (2,), dtype=np.float32)
+        p1[..., 0] = self.dx
+        return p1
+
+
+class RecordingFlow(ConstantFlow):
+    '''ConstantFlow which remembers the size of the images it was given'''
+    def calc(self, img0, img1, flow):
+        self.shape = img0.shape
+        return super().calc(img0, img1, flow)
+
+
+@pytest.fixture
+def contours3(monkeypatch):
+    '''The segmenter is written against OpenCV 3, where findContours also returns the image and a list'''
+    find = cv2.findContours
+    def find3(*args):
+        contours, hierarchy = find(*args)
+        return None, list(contours), hierarchy
+    if len(find(np.zeros((4, 4), np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)) == 2:
+        monkeypatch.setattr(cv2, 'findContours', find3)
+
+
+def blob_scene():
+    background = np.full((480, 640, 3), 200, np.uint8)
+    frame = background.copy()
+    for x in (150, 320, 490):
+        cv2.circle(frame, (x, 240), 50, (30, 60, 90), -1)
+    return background, frame
+
+
+def test_filter_learns_velocity():
+    rng = np.random.default_rng(0)
+    f = ConstantVelocityFilter([0.1, 0.5])
+    for tick in range(1, 40):
+        f.predict()
+        f.correct([0.1 + 0.004 * tick + rng.normal(0, 1e-3), 0.5 + rng.normal(0, 1e-3)])
+    assert abs(f.velocity[0] - 0.004) < 5e-4
+    assert abs(f.velocity[1]) < 5e-4
+    assert abs(f.position[0] - (0.1 + 0.004 * 39)) < 3e-3
+
+
+def test_filter_extrapolate():
+    f = ConstantVelocityFilter([0.2, 0.2])
+    f.state[2:] = [0.01, -0.02]
+    assert np.allclose(f.extrapolate([0.5, 0.5], 3), [0.53, 0.44])
+
+
+def test_flow_updates_do_not_count_motion_twice(monkeypatch):
+    # a true motion of 0.002 of the frame width per tick
+    width = 1280
+    dx = 0.002 * width
+    monkeypatch.setattr(cv2, 'DualTVL1OpticalFlow_create', lambda: ConstantFlow(dx / 2), raising=False)
+    rng = np.random.default_rng(0)
+    # texture, so there are corners near the object
+    frame = rng.integers(0, 255, (720, width, 3), dtype=np.uint8)
+    tracker = processor.TrackerProcessor(FakeCamera(), 3, frame, detectLines=False, readDials=False, pyramid_level=1)
+    tracker.track(frame, (200, 340, 40, 40), None, 'cstr', 1000)
+    start = tracker._tracking[0]['center_scaled'][0]
+    loop = asyncio.new_event_loop()
+    try:
+        # the first frame only sets up the flow
+        for tick in range(36):
+            loop.run_until_complete(tracker.process_frame(frame, tick * tracker.stride))
+    finally:
+        loop.close()
+    t = tracker._tracking[0]
+    assert abs(t['filter'].velocity[0] - 0.002) < 2e-4
+    assert abs(t['center_scaled'][0] - (start + 35 * 0.002)) < 0.01
+
+
+class FinishedWorker:
+    '''Stands in for DarkflowWorker with a result already finished on frame result_ind'''
+    def __init__(self, result_ind, result):
+        self.result_ind = result_ind
+        self.result = result
+        self.submitted = []
+
+    def submit(self, frame, frame_ind):
+        self.submitted.append(frame_ind)
+
+    def latest(self):
+        return self.result_ind, self.result
+
+
+def test_darkflow_segments_ignore_stale_results():
+    box = {'confidence': 0.9, 'topleft': {'x': 10, 'y': 20}, 'bottomright': {'x': 30, 'y': 50}}
+    segmenter = processor.DarkflowSegmentProcessor.__new__(processor.DarkflowSegmentProcessor)
+    segmenter.worker = FinishedWorker(5, [box])
+    segmenter._cache_frame = segmenter._cache_ind = segmenter._result = None
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    assert segmenter.segments(frame, 40, min_ind=30) == []
+    assert segmenter.worker.submitted == [40]
+    segmenter.worker.result_ind = 35
+    assert segmenter.segments(frame, 40, min_ind=30) == [[10, 20, 20, 30]]
+    # the same frame is not sent twice
+    assert segmenter.worker.submitted == [40]
+
+
+def test_darkflow_segments_are_submitted_once_per_frame(monkeypatch):
+    box = {'confidence': 0.9, 'topleft': {'x': 10, 'y': 20}, 'bottomright': {'x': 30, 'y': 50}}
+    segmenter = processor.DarkflowSegmentProcessor(FakeCamera())
+    segmenter.worker = FinishedWorker(1, [box])
+    conversions = []
+    convert = segmenter._segments
+    monkeypatch.setattr(segmenter, '_segments', lambda result: conversions.append(1) or convert(result))
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    loop = asyncio.new_event_loop()
+    try:
+        for _ in range(3):
+            assert segmenter.segments(frame, 1) == [[10, 20, 20, 30]]
+            assert segmenter.segments(frame.copy(), 1) == [[10, 20, 20, 30]]
+            loop.run_until_complete(segmenter.decorate_frame(frame.copy(), 'segment'))
+        assert segmenter.worker.submitted == [1]
+        assert len(conversions) == 1
+        # a new frame is submitted, and only a new result is converted again
+        segmenter.segments(frame.copy(), 2)
+        assert segmenter.worker.submitted == [1, 2]
+        assert len(conversions) == 1
+        segmenter.worker.result_ind, segmenter.worker.result = 2, [box, dict(box, confidence=0.5)]
+        assert len(segmenter.segments(frame, 2)) == 2
+        assert len(conversions) == 2
+    finally:
+        loop.close()
+
+
+def connect_objects_reference(tracking, lines, frame_size, dist_th_lower, dist_th_upper):
+    '''TrackerProcessor._connect_objects before the spatial hash, checking every object, line and object'''
+    source = (frame_size[1], round(frame_size[0] * .5))
+    source_upper = int(200.0 / 720.0 * frame_size[0])
+    source_lower = int(10.0 / 720.0 * frame_size[0])
+    used_lines = []
+    for t1 in tracking:
+        center = (t1['center_scaled'][0] * frame_size[1], t1['center_scaled'][1] * frame_size[0])
+        for k, line in enumerate(lines):
+            if k in used_lines:
+                continue
+            dist_ep1 = distance_pts((center, line['endpoints'][0]))
+            dist_ep2 = distance_pts((center, line['endpoints'][1]))
+            if not (val_in_range(dist_ep1, dist_th_lower, dist_th_upper) or val_in_range(dist_ep2, dist_th_lower, dist_th_upper)):
+                continue
+            endpoint = line['endpoints'][1] if dist_ep1 <= dist_ep2 else line['endpoints'][0]
+            if val_in_range(distance_pts((source, endpoint)), source_lower, source_upper):
+                t1['connectedToSource'] = True
+                used_lines.append(k)
+                break
+            for t2 in tracking:
+                if t1['id'] == t2['id']:
+                    continue
+                if (t2['id'], t2['label']) in t1['connectedToPrimary'] or (t2['id'], t2['label']) in t1['connectedToSecondary']:
+                    continue
+                center2 = (t2['center_scaled'][0] * frame_size[1], t2['center_scaled'][1] * frame_size[0])
+                line_angle = np.pi/2.0 + np.arctan(line['slope'])
+                with np.errstate(invalid='ignore'):
+                    slope, _ = line_from_endpoints((center, center2)) if center[1] > center2[1] else line_from_endpoints((center2, center))
+                if abs(line_angle - (np.pi/2.0 + np.arctan(slope))) > np.pi/6.0:
+                    continue
+                if val_in_range(distance_pts((center2, endpoint)), dist_th_lower, dist_th_upper):
+                    if (center[0] > center2[0]) or (center[0] == center2[0] and center[1] < center2[1]):
+                        t1['connectedToPrimary'].append((t2['id'], t2['label']))
+                        t2['connectedToSecondary'].append((t1['id'], t1['label']))
+                    else:
+                        t2['connectedToPrimary'].append((t1['id'], t1['label']))
+                        t1['connectedToSecondary'].append((t2['id'], t2['label']))
+                    used_lines.append(k)
+                    break
+
+
+class FakeLineDetector:
+    def __init__(self, lines):
+        self.lines = lines
+
+
+def test_connect_objects_matches_reference():
+    rng = np.random.default_rng(0)
+    frame_size = (720, 1280, 3)
+    loop = asyncio.new_event_loop()
+    connections, sources = 0, 0
+    for scene in range(500):
+        # centers on a coarse grid, so objects share coordinates and ties are exercised
+        tracking = [{'id': i, 'label': 'r{}'.format(i), 'connectedToPrimary': [], 'connectedToSecondary': [],
+                     'connectedToSource': False,
+                     'center_scaled': [rng.integers(0, 64) / 64, rng.integers(0, 36) / 36]}
+                    for i in range(rng.integers(1, 15))]
+        lines = []
+        for k in range(rng.integers(1, 15)):
+            endpoints = tuple(np.array([rng.integers(0, 1280), rng.integers(0, 720)]) for _ in range(2))
+            with np.errstate(invalid='ignore'):
+                slope, intercept = line_from_endpoints(endpoints)
+            lines.append({'endpoints': endpoints, 'slope': slope, 'intercept': intercept})
+        expected = copy.deepcopy(tracking)
+        connect_objects_reference(expected, lines, frame_size, 75, 150)
+        tracker = processor.TrackerProcessor.__new__(processor.TrackerProcessor)
+        tracker._tracking = tracking
+        tracker.lineDetector = FakeLineDetector(lines)
+        tracker.dist_th_lower, tracker.dist_th_upper = 75, 150
+        loop.run_until_complete(tracker._connect_objects(frame_size))
+        assert tracking == expected
+        connections += sum(len(t['connectedToPrimary']) for t in expected)
+        sources += sum(t['connectedToSource'] for t in expected)
+    loop.close()
+    # the scenes do have connections to compare
+    assert connections > 100 and sources > 10
+
+
+def test_identify_worker_picks_up_added_templates():
+    rng = np.random.default_rng(0)
+    desc = cv2.ORB_create()
+    images = [cv2.GaussianBlur(rng.integers(0, 255, (200, 200, 3), dtype=np.uint8), (3, 3), 0) for _ in range(3)]
+    templates = []
+    for i, img in enumerate(images):
+        kp, des = desc.detectAndCompute(img, None)
+        t = types.SimpleNamespace(label='t{}'.format(i), id=i, poly=[[0, 0], [0, 199], [199, 199], [199, 0]], color=(0, 0, 0))
+        templates.append((t, pack_keypoints(kp), des, None))
+    # stands in for the shared list, starting with the first two templates
+    shared = templates[:2]
+    params = {'threshold': 0.8, 'min_match': 6, 'weights': [3, -1, -1, -10, 5], 'prefilter_k': 0, 'template_size': None}
+    processor._init_identify_worker(descriptor_config(desc), shared, params)
+    bounds = (0, 0, 200, 200)
+    assert processor._identify_in_worker(2, images[2], (0, 0), bounds, None, set())[2] == {}
+    shared.append(templates[2])
+    features = processor._identify_in_worker(3, images[2], (0, 0), bounds, None, set())[2]
+    assert list(features) == ['t2']
+    assert len(processor._identify_worker['index']) == 3
+
+
+def test_flow_is_scaled_from_the_pyramid_level(monkeypatch):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+    for level in range(3):
+        # a motion of 0.002 of the frame width per tick, in pixels of the pyramid level
+        flow = RecordingFlow(0.002 * 1280 / 2 ** level)
+        monkeypatch.setattr(cv2, 'DualTVL1OpticalFlow_create', lambda: flow, raising=False)
+        tracker = processor.TrackerProcessor(FakeCamera(), 3, frame, detectLines=False, readDials=False,
+                                             motion_model=False, pyramid_level=level)
+        tracker.track(frame, (200, 340, 40, 40), None, 'cstr', 1000)
+        start = tracker._tracking[0]['center_scaled'][0]
+        loop = asyncio.new_event_loop()
+        try:
+            for tick in range(6):
+                loop.run_until_complete(tracker.process_frame(frame, tick * tracker.stride))
+        finally:
+            loop.close()
+        assert flow.shape == (720 // 2 ** level, 1280 // 2 ** level)
+        assert abs(tracker._tracking[0]['center_scaled'][0] - (start + 5 * 0.002)) < 1e-6
+        # corners are kept in full resolution pixels
+        assert tracker.tracks[:, 0].max() > 1280 / 2 and tracker.tracks[:, 1].max() > 720 / 2
+
+
+def test_segments_are_cached_per_frame(contours3, monkeypatch):
+    background, frame = blob_scene()
+    segmenter = processor.SegmentProcessor(FakeCamera(), background, -1, 10)
+    calls = []
+    run = segmenter._filter_background
+    monkeypatch.setattr(segmenter, '_filter_background', lambda *args: calls.append(1) or run(*args))
+    rects = list(segmenter.segments(frame, 5))
+    assert len(rects) == 3
+    # the same frame, a decorated copy of it and no frame at all reuse the segmentation
+    assert list(segmenter.segments(frame, 5)) == rects
+    assert list(segmenter.segments(frame.copy(), 5)) == rects
+    assert list(segmenter.segments(frame)) == rects
+    assert list(segmenter.segments()) == rects
+    assert len(calls) == 1
+    assert list(segmenter.segments(frame.copy(), 6)) == rects
+    assert len(calls) == 2
+    segmenter.invalidate()
+    assert list(segmenter.segments(frame, 6)) == rects
+    assert len(calls) == 3
+    # a new background changes the result, so it must not be served from the cache
+    segmenter.background = frame
+    assert list(segmenter.segments(frame, 6)) == []
+    assert len(calls) == 4
+
+
+def test_segment_streams_reuse_the_segmentation(contours3, monkeypatch):
+    background, frame = blob_scene()
+    camera = FakeCamera()
+    camera.frame, camera.frame_ind = frame, 1
+    segmenter = processor.SegmentProcessor(camera, background, -1, 10, scale=0.5)
+    list(segmenter.segments(frame, 1))
+    calls = []
+    watershed = cv2.watershed
+    monkeypatch.setattr(cv2, 'watershed', lambda *args: calls.append(1) or watershed(*args))
+    monkeypatch.setattr(segmenter, '_filter_background', lambda *args: pytest.fail('segmented again'))
+    loop = asyncio.new_event_loop()
+    try:
+        mask = loop.run_until_complete(segmenter.decorate_frame(frame.copy(), 'bg-thresh'))
+        assert mask.shape == frame.shape[:2]
+        for _ in range(3):
+            decorated = loop.run_until_complete(segmenter.decorate_frame(frame.copy(), 'watershed'))
+            assert decorated.dtype == np.uint8 and decorated.shape == frame.shape
+            assert np.any(np.all(decorated == (255, 0, 0), axis=-1))
+    finally:
+        loop.close()
+    # the markers are computed once and kept out of the streams
+    assert len(calls) == 1
+    assert 'watershed-markers' in segmenter._intermediates
+    assert 'watershed-markers' not in segmenter.streams
+
+
+def template_db(path, n=3):
+    rng = np.random.default_rng(0)
+    db = ImageDB(str(path), load=False)
+    for i in range(n):
+        img = cv2.GaussianBlur(rng.integers(0, 255, (200, 200, 3), dtype=np.uint8), (3, 3), 0)
+        db.store_img(img, 't{}'.format(i), np.array([[0, 0], [0, 200], [200, 200], [200, 0]]))
+    return db
+
+
+def test_descriptor_swap_is_atomic(tmp_path):
+    db = template_db(tmp_path)
+    orb = cv2.ORB_create()
+    detector = processor.DetectionProcessor(FakeCamera(), db.images[0].img, db, orb, track=False)
+    old_index = detector.template_index
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        first = detector.set_descriptor(cv2.AKAZE_create())
+        brisk = cv2.BRISK_create()
+        second = detector.set_descriptor(brisk)
+        # until the new features are all ready, frames see only the old descriptor
+        loop.run_until_complete(asyncio.sleep(0))
+        assert detector.desc is orb and detector.template_index is old_index
+        assert all(t.features.shape[1] == 32 for t in db)
+        assert loop.run_until_complete(first) is False
+        assert detector.desc is orb
+        assert loop.run_until_complete(second) is True
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    # descriptor, index and template features all switch together, and the superseded request left no trace
+    assert detector.desc is brisk and detector.template_index is not old_index
+    assert all(t.features.shape[1] == 64 for t in db)
+    assert all(f.shape[1] == 64 for f in detector.template_index.features)
+    assert db.features_key == features_key(brisk, detector.template_size)
+
+
+def test_template_size_swaps_with_the_descriptor(tmp_path):
+    db = template_db(tmp_path)
+    detector = processor.DetectionProcessor(FakeCamera(), db.images[0].img, db, cv2.ORB_create(), track=False)
+    # templates are not shrunk unless asked
+    assert detector.template_size is None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        resized = detector.set_template_size(64)
+        assert detector.template_size is None
+        # a descriptor change meanwhile keeps the requested size
+        brisk = cv2.BRISK_create()
+        assert loop.run_until_complete(detector.set_descriptor(brisk)) is True
+        assert loop.run_until_complete(resized) is False
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert detector.desc is brisk and detector.template_size == 64
+    assert db.features_key == features_key(brisk, 64)
+    assert sum(len(t.keypoints) for t in db) < sum(len(brisk.detect(t.img)) for t in db)
+
+
+def test_template_keypoints_are_only_pruned_when_asked(tmp_path):
+    db = template_db(tmp_path)
+    detector = processor.DetectionProcessor(FakeCamera(), db.images[0].img, db, cv2.ORB_create(), track=False)
+    assert detector.template_keypoints is None
+    assert [len(f) for f in detector.template_index.features] == [len(t.features) for t in db]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        assert loop.run_until_complete(detector.set_template_keypoints(50)) is True
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    # the templates keep their features, only the index is pruned
+    assert detector.template_keypoints == 50
+    assert all(len(t.features) > 50 for t in db)
+    assert [len(f) for f in detector.template_index.features] == [50] * len(db)
+
+
+def test_tracked_template_is_searched_first():
+    rng = np.random.default_rng(0)
+    orb = cv2.ORB_create()
+    index = TemplateIndex(orb, brute_force=True)
+    images = []
+    for i in range(4):
+        img = cv2.GaussianBlur(rng.integers(0, 255, (200, 200), dtype=np.uint8), (3, 3), 0)
+        t = ImageDB.Image(None, img, 't{}'.format(i), np.array([[0, 0], [0, 200], [200, 200], [200, 0]]))
+        t.set_id(i + 1)
+        index.add(t, *orb.detectAndCompute(img, None))
+        images.append(img)
+    lookups = []
+    match = index.match
+    index.match = lambda des, ratio, candidates=None: lookups.append(candidates) or match(des, ratio, candidates)
+    kp, des = orb.detectAndCompute(images[2], None)
+    bounds = (0, 0, 200, 200)
+
+    def search(tracked, skip=()):
+        del lookups[:]
+        found = processor.search_templates(index, kp, des, bounds, None, skip, tracked, 0.8, 6, [3, -1, -1, -10, 5], 0)
+        return [t.label for t, feature in found if feature is not None]
+    # the tracked template alone is verified, even though it is already in play
+    assert search(2, skip={3}) == ['t2']
+    assert lookups == [[2]]
+    # the whole index is only searched when the tracked template does not verify
+    assert search(1) == ['t2']
+    assert lookups == [[1], None]
+    assert search(None) == ['t2']
+    assert lookups == [None]
@@ -0,0 +1,199 @@
+import math
+import os
+import cv2
+import numpy as np
+import pytest
+from arcvision import utils
+from arcvision.utils import ImageDB, KeypointCache, KeypointBudget, SegmentCache, SpatialHash, TemplateIndex, create_matcher, \
+    line_angles, line_from_endpoints, label_pixels, strongest_keypoints
+
+
+def test_keypoint_cache_evicts_oldest_inserted():
+    cache = KeypointCache(max_frames=2)
+    frame = np.zeros((100, 100, 3), dtype=np.uint8)
+    desc = cv2.ORB_create()
+    # a looping video restarts its frame index
+    for frame_ind in (98, 99, 0):
+        cache.put(desc, frame, (10, 10, 50, 50), frame_ind, ([], None))
+    assert list(cache.frames) == [99, 0]
+
+
+def test_keypoint_budget_averages_start_from_first_sample():
+    budget = KeypointBudget(enabled=True, target_ms=50)
+    # one slow stride should shrink the limit, which an average starting at 0 would hide
+    budget.update(200, 1000, 4, 2, [3.0, 5.0], [0.5, 1.0])
+    assert budget.stats['identify_ms'] == 200
+    assert budget.stats['keypoints_per_segment'] == 250
+    assert budget.stats['identified_fraction'] == 0.5
+    assert budget.stats['mean_score'] == 4.0
+    assert budget.stats['match_precision'] == 0.75
+    assert budget.limit < KeypointBudget.CEILING
+    budget.update(100, 1000, 4, 2, [3.0, 5.0])
+    assert abs(budget.stats['identify_ms'] - (200 * 0.8 + 100 * 0.2)) < 1e-9
+
+
+def test_spatial_hash_finds_every_point_in_radius():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-500, 1500, (300, 2))
+    grid = SpatialHash(150)
+    for i, p in enumerate(points):
+        grid.insert(i, p)
+    for q in rng.uniform(-500, 1500, (50, 2)):
+        for radius in (10, 150, 400):
+            found = grid.query(q, radius)
+            near = [i for i, p in enumerate(points) if math.hypot(*(p - q)) <= radius]
+            assert set(near) <= set(found)
+            assert found == sorted(found)
+
+
+def test_line_angles_match_line_from_endpoints():
+    rng = np.random.default_rng(0)
+    # a coarse grid, so points share x or y coordinates often
+    points = rng.integers(0, 8, (200, 2)) * 50
+    for center in points[:40]:
+        angles = line_angles(center, points)
+        for p, angle in zip(points, angles):
+            # _connect_objects orders the endpoints by y, as line detection does.
+            # Vertical lines have an undefined intercept, which is not used
+            with np.errstate(invalid='ignore'):
+                slope, _ = line_from_endpoints((center, p)) if center[1] > p[1] else line_from_endpoints((p, center))
+            assert np.isclose(angle, np.pi / 2 + np.arctan(slope))
+
+
+def test_label_pixels_match_argwhere():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(-1, 6, (40, 60)).astype(np.int32)
+    labels[labels == 3] = 0
+    grouped = label_pixels(labels, 1, 6)
+    expected = [(label, np.argwhere(labels == label)) for label in range(1, 6) if np.any(labels == label)]
+    assert [label for label, _ in grouped] == [label for label, _ in expected]
+    for (_, pixels), (_, want) in zip(grouped, expected):
+        assert np.array_equal(pixels, want)
+    assert label_pixels(np.zeros((4, 4), dtype=np.int32)) == []
+
+
+def template_index(images, desc=None, brute_force=True):
+    if desc is None:
+        desc = cv2.ORB_create()
+    index = TemplateIndex(desc, brute_force=brute_force)
+    for i, img in enumerate(images):
+        kp, des = desc.detectAndCompute(img, None)
+        index.add('t{}'.format(i), kp, des)
+    return desc, index
+
+
+def test_template_index_match():
+    rng = np.random.default_rng(0)
+    images = [cv2.GaussianBlur(rng.integers(0, 255, (200, 200), dtype=np.uint8), (3, 3), 0) for _ in range(4)]
+    desc, index = template_index(images)
+    kp, des = desc.detectAndCompute(images[2], None)
+    votes = index.match(des, 0.8)
+    assert max(votes, key=lambda i: len(votes[i])) == 2
+    # candidates narrow the lookup in the same index to their votes, keyed by index position
+    def query_ids(v):
+        return {i: [m.queryIdx for m in ms] for i, ms in v.items()}
+    for candidates in ([2], [1, 2], [0, 3]):
+        expected = {i: ms for i, ms in query_ids(votes).items() if i in candidates}
+        assert query_ids(index.match(des, 0.8, candidates)) == expected
+    assert index.match(None, 0.8) == {}
+
+
+@pytest.mark.parametrize('desc, dtype', [(cv2.ORB_create(), np.uint8), (cv2.KAZE_create(), np.float32)])
+def test_template_index_flann(desc, dtype):
+    # LSH for binary descriptors and a KD-tree for float ones
+    matcher, matcher_dtype = create_matcher(desc)
+    assert isinstance(matcher, cv2.FlannBasedMatcher) and matcher_dtype == dtype
+    assert isinstance(create_matcher(desc, brute_force=True)[0], cv2.BFMatcher)
+    rng = np.random.default_rng(0)
+    images = [cv2.GaussianBlur(rng.integers(0, 255, (200, 200), dtype=np.uint8), (3, 3), 0) for _ in range(4)]
+    desc, index = template_index(images, desc, brute_force=False)
+    assert all(f.dtype == dtype for f in index.features)
+    for i in range(len(images)):
+        kp, des = desc.detectAndCompute(images[i], None)
+        votes = index.match(des, 0.8)
+        assert max(votes, key=lambda j: len(votes[j])) == i
+        assert set(index.match(des, 0.8, [i])) == {i}
+
+
+def make_keypoints(points, responses):
+    kp = [cv2.KeyPoint(float(x), float(y), 5, -1, float(r)) for (x, y), r in zip(points, responses)]
+    des = np.arange(len(kp), dtype=np.uint8).reshape(-1, 1)
+    return kp, des
+
+
+def test_strongest_keypoints():
+    kp, des = make_keypoints([(i, i) for i in range(6)], [0.1, 0.6, 0.3, 0.9, 0.2, 0.5])
+    strong, strong_des = strongest_keypoints(kp, des, 3)
+    assert [k.response for k in strong] == [np.float32(r) for r in (0.9, 0.6, 0.5)]
+    assert strong_des.ravel().tolist() == [3, 1, 5]
+    # no limit, or few enough already
+    assert strongest_keypoints(kp, des, None)[0] is kp
+    assert strongest_keypoints(kp, des, 6)[0] is kp
+
+
+def test_strongest_keypoints_spread_over_grid():
+    # the strongest are all in the top left, one weak keypoint in each other quadrant
+    points = [(0, 0), (1, 1), (2, 2), (3, 3), (100, 0), (0, 100), (100, 100)]
+    kp, des = make_keypoints(points, [0.9, 0.8, 0.7, 0.6, 0.1, 0.2, 0.3])
+    strong, strong_des = strongest_keypoints(kp, des, 4, grid=2)
+    assert sorted(strong_des.ravel().tolist()) == [0, 4, 5, 6]
+    # the second round of the grid comes after every cell's first
+    strong, strong_des = strongest_keypoints(kp, des, 5, grid=2)
+    assert strong_des.ravel().tolist()[-1] == 1
+
+
+def test_feature_cache_round_trip(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    db = ImageDB(str(tmp_path), load=False)
+    for i in range(2):
+        img = cv2.GaussianBlur(rng.integers(0, 255, (200, 200, 3), dtype=np.uint8), (3, 3), 0)
+        db.store_img(img, 't{}'.format(i), np.array([[0, 0], [0, 200], [200, 200], [200, 0]]))
+    db.compute_features(cv2.ORB_create())
+    cache_dir = tmp_path / ImageDB.FEATURE_CACHE
+    assert len(os.listdir(cache_dir)) == 2
+    # a fresh database over the same templates reads the features back instead of computing them
+    monkeypatch.setattr(utils, 'detect_and_compute', lambda *args: pytest.fail('features were recomputed'))
+    loaded = ImageDB(str(tmp_path))
+    loaded.compute_features(cv2.ORB_create())
+    for a, b in zip(sorted(db, key=lambda i: i.label), sorted(loaded, key=lambda i: i.label)):
+        assert np.array_equal(a.features, b.features)
+        assert [k.pt for k in a.keypoints] == [k.pt for k in b.keypoints]
+    monkeypatch.undo()
+    # entries for other descriptor settings or removed templates are pruned
+    (cache_dir / '{}-{}.features'.format('0' * 32, utils.features_key(cv2.ORB_create()))).write_bytes(b'')
+    loaded.compute_features(cv2.ORB_create(nfeatures=100), max_size=128)
+    names = os.listdir(cache_dir)
+    assert len(names) == 2
+    assert all(utils.features_key(cv2.ORB_create(nfeatures=100), 128) in n for n in names)
+
+
+def test_segment_cache_reuses_unchanged_segments():
+    rng = np.random.default_rng(0)
+    frame = cv2.GaussianBlur(rng.integers(0, 255, (240, 320, 3), dtype=np.uint8), (5, 5), 0)
+    rect, other, tag = (100, 80, 60, 50), (10, 10, 40, 40), object()
+    cache = SegmentCache(max_age=3)
+    cache.begin()
+    fingerprint, value = cache.get(frame, rect, tag)
+    assert value is None
+    cache.put(rect, fingerprint, 'features', tag)
+    cache.put(other, cache.get(frame, other, tag)[0], 'other', tag)
+    cache.end()
+    cache.begin()
+    # unchanged pixels and a rect moved a little by segmentation hit, another tag misses
+    assert cache.get(frame, (102, 79, 61, 50), tag)[1] == 'features'
+    assert cache.get(frame, other, object())[1] is None
+    cache.end()
+    cache.begin()
+    # the other segment was not seen last frame, so it is forgotten
+    assert cache.get(frame, other, tag)[1] is None
+    changed = frame.copy()
+    cv2.rectangle(changed, (100, 80), (160, 130), (0, 0, 0), -1)
+    assert cache.get(changed, rect, tag)[1] is None
+    assert cache.get(frame, rect, tag)[1] == 'features'
+    cache.end()
+    # even unchanged segments are recomputed after max_age reuses
+    cache.begin()
+    assert cache.get(frame, rect, tag)[1] == 'features'
+    cache.end()
+    cache.begin()
+    assert cache.get(frame, rect, tag)[1] is None